@@ -40,6 +40,8 @@ class _Config:
         self.db = './data/CamRest676/CamRestDB.json'
         self.glove_path = './data/glove/glove.6B.50d.txt'
         self.batch_size = 32
+        self.batch_mode = 'turn' # 'turn', 'length', 'token' or 'masked', see _ReaderBase._batch_dialogs
+        self.batch_tokens = 8000 # padded tokens per batch in 'token' batch mode
         self.z_length = 8
         self.degree_size = 5
         self.layer_num = 1
@@ -62,6 +64,19 @@ class _Config:
         self.skip_unsup = False
         self.truncated = False
         self.pretrain = False
+        self.copy_mode = 'index' # 'index' or 'dense'
+        self.turn_parallel = False # decode all turns of a dialog batch at once in training
+        # turn-parallel decodes the turns whose lengths fall into the same buckets of this many tokens as one batch,
+        # masking the extra padding; 1 only groups turns of equal lengths
+        self.turn_parallel_bucket = 8
+        self.shrink_finished = True # drop finished responses from the batch in greedy decoding
+        self.attn_key_cache = True # project attention keys once per turn instead of every step
+        self.log_proba = True # decoders return log-probabilities in training and beam search
+        self.degree_cache_size = 4096 # db degree vectors cached by constraint set at test time, 0 disables
+        self.cache_dir = './data/CamRest676/' # encoded data is cached here, keyed by its input files, '' disables
+        self.batch_plan_dir = '' # padded batches are saved in this directory for reruns, '' disables
+        self.prefetch_depth = 2 # batches converted ahead by a worker thread, 0 converts inline
+        self.tokenize_workers = 4 # processes tokenizing the dialogs of a split, 1 tokenizes inline
 
     def _kvret_tsdf_init(self):
         self.prev_z_method = 'separate'
@@ -79,6 +94,8 @@ class _Config:
         self.entity = './data/kvret/kvret_entities.json'
         self.glove_path = './data/glove/glove.6B.50d.txt'
         self.batch_size = 32
+        self.batch_mode = 'turn' # 'turn', 'length', 'token' or 'masked', see _ReaderBase._batch_dialogs
+        self.batch_tokens = 8000 # padded tokens per batch in 'token' batch mode
         self.degree_size = 5
         self.z_length = 8
         self.layer_num = 1
@@ -102,6 +119,19 @@ class _Config:
         self.skip_unsup = False
         self.truncated = False
         self.pretrain = False
+        self.copy_mode = 'index' # 'index' or 'dense'
+        self.turn_parallel = False # decode all turns of a dialog batch at once in training
+        # turn-parallel decodes the turns whose lengths fall into the same buckets of this many tokens as one batch,
+        # masking the extra padding; 1 only groups turns of equal lengths
+        self.turn_parallel_bucket = 8
+        self.shrink_finished = True # drop finished responses from the batch in greedy decoding
+        self.attn_key_cache = True # project attention keys once per turn instead of every step
+        self.log_proba = True # decoders return log-probabilities in training and beam search
+        self.degree_cache_size = 4096 # db degree vectors cached by constraint set at test time, 0 disables
+        self.cache_dir = './data/kvret/' # encoded data is cached here, keyed by its input files, '' disables
+        self.batch_plan_dir = '' # padded batches are saved in this directory for reruns, '' disables
+        self.prefetch_depth = 2 # batches converted ahead by a worker thread, 0 converts inline
+        self.tokenize_workers = 4 # processes tokenizing the dialogs of a split, 1 tokenizes inline
 
     def __str__(self):
         s = ''
@@ -115,11 +115,15 @@ def report(func):
 
 
 class GenericEvaluator:
+    clean_cache_size = 65536  # delexicalised strings kept by clean and clean_by_intent, least recently used first out
+
     def __init__(self, result_path):
         self.file = open(result_path,'r')
         self.meta = []
         self.metric_dict = {}
         self.entity_dict = {}
+        self._entity_matcher = None
+        self._clean_cache = functools.lru_cache(maxsize=self.clean_cache_size)(self._clean)
         filename = result_path.split('/')[-1]
         dump_dir = './sheets/' + filename.replace('.csv','.report.txt')
         self.dump_file = open(dump_dir,'w')
@@ -186,7 +190,11 @@ class GenericEvaluator:
             self.dump_file.write('{}\t{}\n'.format(k,v))
 
     def clean(self,s,ifreader = False):
-        from reader import clean_replace
+        s, slot_list = self._clean_cache(s, ifreader)
+        return s, list(slot_list)
+
+    def _clean(self, s, ifreader):
+        from reader import clean_replace, EntityMatcher
         s = s.replace('<go> ', '').replace(' SLOT', '_SLOT')
         if ifreader:
             pass
@@ -194,16 +202,20 @@ class GenericEvaluator:
             s = '<GO> ' + s + ' </s>'
         slot_list = []
         assert(len(self.entity_dict)>0)
-        for item in self.entity_dict:
-            
+        if self._entity_matcher is None:
+            # entity_dict is matched in its own order, entries not occurring in s are skipped
+            self._entity_matcher = EntityMatcher(self.entity_dict, longest_first=False)
+
+        def replace_item(s, item, k):
             # s = s.replace(item, 'VALUE_{}'.format(self.entity_dict[item]))
-            s1 = clean_replace(s, item, '{}_SLOT'.format(self.entity_dict[item]))
+            s1 = clean_replace(s, item, '{}_SLOT'.format(k))
             if s1 != s:
                 slot_list.append(item)
                 #print("slot_list", slot_list)
-            s= s1
+            return s1
 
-        return s,slot_list
+        s = self._entity_matcher.replace(s, replace_item)
+        return s, tuple(slot_list)
 
 
 class CamRestEvaluator(GenericEvaluator):
@@ -258,6 +270,8 @@ class CamRestEvaluator(GenericEvaluator):
             self.entities.extend(entity_data['informable'][k])
             for item in entity_data['informable'][k]:
                 self.entity_dict[item] = k
+        self._entity_matcher = None
+        self._clean_cache.cache_clear()
 
     def _extract_constraint(self, z):
         z = z.split()
@@ -398,6 +412,7 @@ class CamRestEvaluator(GenericEvaluator):
 class KvretEvaluator(GenericEvaluator):
     def __init__(self, result_path):
         super().__init__(result_path)
+        self._intent_clean_cache = functools.lru_cache(maxsize=self.clean_cache_size)(self._clean_by_intent)
         ent_json = open('./data/kvret/kvret_entities.json')
         self.ent_data = json.loads(ent_json.read().lower())
         self._get_entity_dict(self.ent_data)
@@ -416,20 +431,25 @@ class KvretEvaluator(GenericEvaluator):
         self._print_dict(self.metric_dict)
 
     def clean_by_intent(self,s,i):
-        from reader import clean_replace
+        return self._intent_clean_cache(s, self.raw_data[i]['scenario']['task']['intent'])
+
+    def _clean_by_intent(self, s, intent):
+        from reader import clean_replace, EntityMatcher
         s = s.replace('<go> ', '').replace(' SLOT', '_SLOT')
         s = '<GO> ' + s + ' </s>'
-        intent = self.raw_data[i]['scenario']['task']['intent']
         slot = {
             'weather':['weather_attribute','location','weekly_time'],
             'navigate':['poi','poi_type','distance','traffic','address'],
             'schedule':['event','date','time','party','room','agenda']
         }
-
-        for item in self.entity_dict:
-            if self.entity_dict[item] in slot[intent]:
-                # s = s.replace(item, 'VALUE_{}'.format(self.entity_dict[item]))
-                s = clean_replace(s, item, '{}_SLOT'.format(self.entity_dict[item]))
+        if intent not in self._intent_matchers:
+            # the entities of the intent's slots, in the order of entity_dict
+            self._intent_matchers[intent] = EntityMatcher(
+                {item: k for item, k in self.entity_dict.items() if k in slot[intent]}, longest_first=False)
+
+        # s = s.replace(item, 'VALUE_{}'.format(self.entity_dict[item]))
+        s = self._intent_matchers[intent].replace(
+            s, lambda s, item, k: clean_replace(s, item, '{}_SLOT'.format(k)))
         return s
 
 
@@ -493,6 +513,8 @@ class KvretEvaluator(GenericEvaluator):
                         if entity_type in ['event', 'poi_type']:
                             entity_dict[entity.split()[0]] = entity_type
         self.entity_dict = entity_dict
+        self._intent_matchers = {}
+        self._intent_clean_cache.cache_clear()
 
     @report
     def match_rate_metric(self, data, sub='match',bspans='./data/kvret/test.bspan.pkl'):
@@ -7,13 +7,88 @@ from reader import KvretReader
 from tsd_net import TSD, cuda_, nan
 from torch.optim import Adam, RMSprop
 from torch.autograd import Variable
-from reader import pad_sequences
 import argparse, time
+import threading, queue
 
 from metric import CamRestEvaluator, KvretEvaluator
 import logging
 
 
+class BatchPrefetcher:
+    """
+    converts the turns of upcoming batches in a worker thread while the model works on the current one.
+    Iterating yields (plan_batch, converted turns); at most depth converted batches wait in the queue,
+    depth 0 converts in the calling thread. With per_turn False, convert takes the whole plan batch.
+    A consumer that may stop before the last batch calls close() so the worker does not block on a full queue.
+    """
+    _end = object()
+    _put_timeout = 0.1
+
+    def __init__(self, batches, convert, depth, per_turn=True):
+        # the batch order is drawn here, in the calling thread, so the random state does not depend on the worker
+        self.batches = list(batches)
+        self.convert = convert
+        self.depth = depth
+        self.per_turn = per_turn
+        self._stop = threading.Event()
+
+    def close(self):
+        """
+        stop the worker, it exits at its next put
+        """
+        self._stop.set()
+
+    def _convert_batch(self, plan_batch):
+        if not self.per_turn:
+            return plan_batch, self.convert(plan_batch)
+        return plan_batch, [self.convert(plan_turn) for plan_turn in plan_batch]
+
+    def _put(self, out_queue, item):
+        """
+        put item into the queue unless the iterator is closed first
+        :return: False if the iterator was closed
+        """
+        while not self._stop.is_set():
+            try:
+                out_queue.put(item, timeout=self._put_timeout)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _work(self, out_queue):
+        try:
+            if cfg.cuda:
+                torch.cuda.set_device(cfg.cuda_device)
+            for plan_batch in self.batches:
+                if not self._put(out_queue, self._convert_batch(plan_batch)):
+                    return
+        except Exception as e:
+            self._put(out_queue, e)
+        self._put(out_queue, self._end)
+
+    def __iter__(self):
+        if not self.depth:
+            for plan_batch in self.batches:
+                yield self._convert_batch(plan_batch)
+            return
+        self._stop.clear()
+        out_queue = queue.Queue(maxsize=self.depth)
+        worker = threading.Thread(target=self._work, args=(out_queue,), daemon=True)
+        worker.start()
+        try:
+            while True:
+                item = out_queue.get()
+                if item is self._end:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            self.close()
+        worker.join()
+
+
 class Model:
     def __init__(self, dataset):
         reader_dict = {
@@ -48,97 +123,39 @@ class Model:
         self.base_epoch = -1
 
     def _convert_batch(self, py_batch, prev_z_py=None,prev_z1_py=None,prev_z2_py=None,prev_z3_py=None):
-        
-        if prev_z_py is None:
-            prev_z_py = [[self.reader.vocab.encode('EOS_Z1'),self.reader.vocab.encode('EOS_Z2')]] * len(py_batch['bspan']) #  this is the bspan of all. 
-            #print(turn_batch['bspan'])
-            #print(prev_z)
-        if prev_z1_py is None:
-            prev_z1_py = [[self.reader.vocab.encode('EOS_Z1')]] * len(py_batch['constraint'])
-        if prev_z2_py is None:
-            prev_z2_py = [[self.reader.vocab.encode('EOS_Z2')]]*len(py_batch['user_tag'])
-        if prev_z3_py is None:
-            prev_z3_py = [[self.reader.vocab.encode('<split>')]]* len(py_batch['system'])
-
-        
-        
-        u_input_py = py_batch['user']
-        u_len_py = py_batch['u_len']
+        arrays = self.reader.pad_turn_batch(py_batch)
+        arrays.update(self.reader.pad_prev_z(len(py_batch['bspan']), prev_z_py, prev_z1_py, prev_z2_py, prev_z3_py))
+        return self._tensorize_batch(py_batch, arrays)
+
+    def _tensorize_batch(self, py_batch, arrays):
+        """
+        wrap the padded arrays of a turn batch into model inputs
+        :param arrays: fields of reader.pad_turn_batch and reader.pad_prev_z
+        """
+        converted = self._tensorize_turn(py_batch, arrays)
+        self._tensorize_prev_z(arrays, converted[-1])
+        return converted
+
+    def _tensorize_prev_z(self, arrays, kw_ret):
+        """
+        add the previous bspan inputs of reader.pad_prev_z to kw_ret
+        """
+        for key in ['prev_z', 'prev_z1', 'prev_z2', 'prev_z3']:
+            kw_ret[key + '_len'] = arrays[key + '_len']
+            kw_ret[key + '_input'] = cuda_(Variable(torch.from_numpy(arrays[key + '_input_np']).long()))
+            kw_ret[key + '_input_np'] = arrays[key + '_input_np']
+
+    def _tensorize_turn(self, py_batch, arrays):
+        """
+        wrap the fields of reader.pad_turn_batch, everything but the previous bspan
+        """
         kw_ret = {}
-       
-        for i in range(len(prev_z_py)):
-            eob = self.reader.vocab.encode('EOS_Z2')
-            if eob in prev_z_py[i] and prev_z_py[i].index(eob) != len(prev_z_py[i]) - 1:
-                idx = prev_z_py[i].index(eob)
-                prev_z_py[i] = prev_z_py[i][:idx + 1]
-            for j, word in enumerate(prev_z_py[i]):
-                if word >= cfg.vocab_size:
-                    prev_z_py[i][j] = 2 #unk
-        for i in range(len(prev_z1_py)):
-            eob = self.reader.vocab.encode('EOS_Z1')
-            if eob in prev_z1_py[i] and prev_z1_py[i].index(eob) != len(prev_z1_py[i]) - 1:
-                idx = prev_z1_py[i].index(eob)
-                prev_z1_py[i] = prev_z1_py[i][:idx + 1]
-            
-        for i in range(len(prev_z2_py)):
-            eob = self.reader.vocab.encode('EOS_Z2')
-            if eob in prev_z2_py[i] and prev_z2_py[i].index(eob) != len(prev_z2_py[i]) - 1:
-                idx = prev_z2_py[i].index(eob)
-                prev_z2_py[i] = prev_z2_py[i][:idx + 1]
-            
-        for i in range(len(prev_z3_py)):
-            eob = self.reader.vocab.encode('<split>')
-            if eob in prev_z3_py[i] and prev_z3_py[i].index(eob) != len(prev_z3_py[i]) - 1:
-                idx = prev_z3_py[i].index(eob)
-                prev_z3_py[i] = prev_z3_py[i][:idx + 1]    
-
-
-
-        prev_z_input_np = pad_sequences(prev_z_py, cfg.max_ts, padding='post', truncating='pre').transpose((1, 0))
-        prev_z_len = np.array([len(_) for _ in prev_z_py])
-        prev_z_input = cuda_(Variable(torch.from_numpy(prev_z_input_np).long()))
-        kw_ret['prev_z_len'] = prev_z_len
-        kw_ret['prev_z_input'] = prev_z_input
-        kw_ret['prev_z_input_np'] = prev_z_input_np
-
-
-
-        prev_z1_input_np = pad_sequences(prev_z1_py, cfg.max_ts, padding='post', truncating='pre').transpose((1, 0))
-        prev_z1_len = np.array([len(_) for _ in prev_z1_py])
-        prev_z1_input = cuda_(Variable(torch.from_numpy(prev_z1_input_np).long()))
-        kw_ret['prev_z1_len'] = prev_z1_len
-        kw_ret['prev_z1_input'] = prev_z1_input
-        kw_ret['prev_z1_input_np'] = prev_z1_input_np
-
-        prev_z2_input_np = pad_sequences(prev_z2_py, cfg.max_ts, padding='post', truncating='pre').transpose((1, 0))
-        prev_z2_len = np.array([len(_) for _ in prev_z2_py])
-        prev_z2_input = cuda_(Variable(torch.from_numpy(prev_z2_input_np).long()))
-        kw_ret['prev_z2_len'] = prev_z2_len
-        kw_ret['prev_z2_input'] = prev_z2_input
-        kw_ret['prev_z2_input_np'] = prev_z2_input_np
-
-        prev_z3_input_np = pad_sequences(prev_z3_py, cfg.max_ts, padding='post', truncating='pre').transpose((1, 0))
-        prev_z3_len = np.array([len(_) for _ in prev_z3_py])
-        prev_z3_input = cuda_(Variable(torch.from_numpy(prev_z3_input_np).long()))
-        kw_ret['prev_z3_len'] = prev_z3_len
-        kw_ret['prev_z3_input'] = prev_z3_input
-        kw_ret['prev_z3_input_np'] = prev_z3_input_np
-
-        degree_input_np = np.array(py_batch['degree'])
-        u_input_np = pad_sequences(u_input_py, cfg.max_ts, padding='post', truncating='pre').transpose((1, 0))
-
-        z_input_np = pad_sequences(py_batch['bspan'], padding='post').transpose((1, 0))
-        # z1_input_np = pad_sequences(py_batch['constraint'], padding='post').transpose((1, 0))
-        z1_input_np = pad_sequences(py_batch['bspan'], padding='post').transpose((1, 0))
-        z2_input_np = pad_sequences(py_batch['user_tag'], padding='post').transpose((1, 0))
-        z3_input_np = pad_sequences(py_batch['system'], padding='post').transpose((1, 0))
-        m_input_np = pad_sequences(py_batch['response'], cfg.max_ts, padding='post', truncating='post').transpose(
-            (1, 0))
-
-        u_len = np.array(u_len_py)
-        m_len = np.array(py_batch['m_len'])
-
-        degree_input = cuda_(Variable(torch.from_numpy(degree_input_np).float()))
+        u_input_np, m_input_np = arrays['u_input_np'], arrays['m_input_np']
+        z_input_np, z1_input_np = arrays['z_input_np'], arrays['z1_input_np']
+        z2_input_np, z3_input_np = arrays['z2_input_np'], arrays['z3_input_np']
+        u_len, m_len = arrays['u_len'], arrays['m_len']
+
+        degree_input = cuda_(Variable(torch.from_numpy(arrays['degree_input_np']).float()))
         u_input = cuda_(Variable(torch.from_numpy(u_input_np).long()))
         z_input = cuda_(Variable(torch.from_numpy(z_input_np).long()))
         z1_input = cuda_(Variable(torch.from_numpy(z1_input_np).long()))
@@ -146,6 +163,8 @@ class Model:
         z3_input = cuda_(Variable(torch.from_numpy(z3_input_np).long()))
         m_input = cuda_(Variable(torch.from_numpy(m_input_np).long()))
 
+        if 'z_copy_np' in arrays:
+            kw_ret['z_copy_np'] = arrays['z_copy_np']
         kw_ret['z_input_np'] = z_input_np
         kw_ret['z1_input_np'] = z1_input_np
         kw_ret['z2_input_np'] = z2_input_np
@@ -157,10 +176,116 @@ class Model:
         return u_input, u_input_np, z_input, z1_input,z2_input,z3_input,m_input, m_input_np,u_len, m_len,  \
                degree_input, kw_ret
 
+    def _plan_turn_inputs(self, plan_turn):
+        return self._tensorize_batch(plan_turn['batch'], dict(plan_turn['arrays'], **plan_turn['prev_arrays']))
+
+    def _prefetch(self, set_name, with_prev_z=True, turn_parallel=False):
+        """
+        batches of a split plan with their turns converted ahead by a BatchPrefetcher, see cfg.prefetch_depth
+        :param with_prev_z: convert the previous bspan of the plan too, False when it is decoded on the fly
+        :param turn_parallel: convert the turns of a batch in groups, see _turn_parallel_inputs
+        """
+        if turn_parallel:
+            return BatchPrefetcher(self.reader.batch_plan_iterator(set_name), self._turn_parallel_inputs,
+                                   cfg.prefetch_depth, per_turn=False)
+        if with_prev_z:
+            convert = self._plan_turn_inputs
+        else:
+            convert = lambda plan_turn: self._tensorize_turn(plan_turn['batch'], plan_turn['arrays'])
+        return BatchPrefetcher(self.reader.batch_plan_iterator(set_name), convert, cfg.prefetch_depth)
+
+    # time-major fields whose own padded length a turn-parallel row keeps, see TSD.turn_parallel_loss
+    _pad_length_fields = [('u', 'u_input_np'), ('prev_z', 'prev_z_input_np'), ('z', 'z_input_np'),
+                          ('z3', 'z3_input_np')]
+
+    def _turn_parallel_inputs(self, plan_batch):
+        """
+        group the turns of a plan batch whose padded sequence lengths fall into the same buckets of
+        cfg.turn_parallel_bucket tokens, and convert every group as one batch padded to its longest turn.
+        In training the previous bspan is the ground truth one, so the turns do not depend on each other.
+        The own padded lengths of every row go to the model as pad_lengths and the extra padding is masked,
+        so the losses are those of sequential training.
+        :return: list of (turn numbers, converted inputs, slice of rows belonging to each turn), one per group
+        """
+        bucket = max(cfg.turn_parallel_bucket, 1)
+        groups = {}
+        for turn_num, plan_turn in enumerate(plan_batch):
+            arrays = dict(plan_turn['arrays'], **plan_turn['prev_arrays'])
+            # the other sequences are either not used in training or only padded in their loss targets
+            lengths = tuple((arrays[k].shape[0] + bucket - 1) // bucket
+                            for k in [k for _, k in self._pad_length_fields] + ['m_input_np'])
+            groups.setdefault(lengths, []).append((turn_num, plan_turn['batch'], arrays))
+        inputs = []
+        for group in groups.values():
+            merged_batch, turn_slices, start = {}, [], 0
+            for turn_num, turn_batch, arrays in group:
+                for k in turn_batch:
+                    merged_batch.setdefault(k, []).extend(turn_batch[k])
+                size = len(turn_batch['bspan'])
+                turn_slices.append(slice(start, start + size))
+                start += size
+            merged_arrays = {}
+            for k, v in group[0][2].items():
+                if v.ndim == 2 and k != 'degree_input_np':
+                    # sequences are time-major [T,B], padded at the end to the longest turn of the group
+                    max_len = max(arrays[k].shape[0] for _, _, arrays in group)
+                    merged_arrays[k] = np.concatenate([np.pad(arrays[k], ((0, max_len - arrays[k].shape[0]), (0, 0)),
+                                                              'constant') for _, _, arrays in group], axis=1)
+                else:
+                    merged_arrays[k] = np.concatenate([arrays[k] for _, _, arrays in group], axis=0)
+            converted = self._tensorize_batch(merged_batch, merged_arrays)
+            pad_lengths = {}
+            for name, k in self._pad_length_fields:
+                own = np.concatenate([np.full(arrays[k].shape[1], arrays[k].shape[0]) for _, _, arrays in group])
+                if (own < merged_arrays[k].shape[0]).any():
+                    pad_lengths[name] = own
+            converted[-1]['pad_lengths'] = pad_lengths
+            inputs.append(([_[0] for _ in group], converted, turn_slices))
+        return inputs
+
+    def _train_turn_parallel(self, inputs, optim):
+        """
+        one optimization step over all turns of a dialog batch, see cfg.turn_parallel
+        :param inputs: groups of turns of _turn_parallel_inputs
+        :return: list of per-turn losses
+        """
+        optim.zero_grad()
+        turn_losses = {}
+        for turn_nums, converted, turn_slices in inputs:
+            u_input, u_input_np, z_input,z1_input,z2_input,z3_input, m_input, m_input_np, u_len, \
+            m_len, degree_input, kw_ret \
+                = converted
+            group_losses = self.m.turn_parallel_loss(turn_slices, u_input=u_input, z_input=z_input,
+                                                     z1_input=z1_input, z2_input=z2_input,z3_input=z3_input,
+                                                     m_input=m_input,
+                                                     degree_input=degree_input,
+                                                     u_input_np=u_input_np,
+                                                     m_input_np=m_input_np,
+                                                     turn_states={},
+                                                     u_len=u_len, m_len=m_len, mode='train', **kw_ret)
+            turn_losses.update(zip(turn_nums, group_losses))
+        turn_losses = [turn_losses[_] for _ in sorted(turn_losses)]
+        loss = sum(_[0] for _ in turn_losses)
+        loss.backward()
+        grad = torch.nn.utils.clip_grad_norm_(self.m.parameters(), 5.0)
+        optim.step()
+        for turn_loss, pr_loss, pr1_loss, pr2_loss, pr3_loss, m_loss in turn_losses:
+            logging.debug(
+                'loss:{} pr_loss:{} pr1_loss:{} pr2_loss:{} pr3_loss:{} m_loss:{} grad:{}'.format(turn_loss.item(),
+                                                                   pr_loss.item(),
+                                                                   pr1_loss.item(),
+                                                                   pr2_loss.item(),
+                                                                   pr3_loss.item(),
+                                                                   m_loss.item(),
+                                                                   grad))
+        return [_[0].item() for _ in turn_losses]
+
     def train(self):
         lr = cfg.lr
         prev_min_loss, early_stop_count = 1 << 30, cfg.early_stop_count
         train_time = 0
+        # the train plan is built once, so its padding efficiency is the same in every epoch
+        logging.info('padding efficiency of the train plan: %f' % self.reader.padding_efficiency('train'))
         for epoch in range(cfg.epoch_num):
             sw = time.time()
             if epoch <= self.base_epoch:
@@ -169,65 +294,64 @@ class Model:
             self.m.self_adjust(epoch)
             sup_loss = 0
             sup_cnt = 0
-            data_iterator = self.reader.mini_batch_iterator('train')
+            turn_groups = 0
+            # batches are padded once per split, the previous bspan of a turn is the ground truth one
             optim = self.optim
-            for iter_num, dial_batch in enumerate(data_iterator):
-                turn_states = {}
-                prev_z = None
-                prev_z1 = None
-                prev_z2 = None
-                prev_z3 = None
-                for turn_num, turn_batch in enumerate(dial_batch):
-                    if prev_z is None:
-                        prev_z = [[self.reader.vocab.encode('EOS_Z1'), self.reader.vocab.encode('EOS_Z2')]] * len(turn_batch['bspan']) # : this is the bspan of all. 
-                    if prev_z1 is None:
-                        prev_z1 = [[self.reader.vocab.encode('EOS_Z1')]] * len(turn_batch['constraint'])
-                    if prev_z2 is None:
-                        prev_z2 = [[self.reader.vocab.encode('EOS_Z2')]]*len(turn_batch['user_tag'])
-                    if prev_z3 is None:
-                        prev_z3 = [[self.reader.vocab.encode('<split>')]]* len(turn_batch['system'])
-
-
-                    if cfg.truncated:
-                        logging.debug('iter %d turn %d' % (iter_num, turn_num))
-                    optim.zero_grad()
-                    u_input, u_input_np, z_input,z1_input,z2_input,z3_input, m_input, m_input_np, u_len, \
-                    m_len, degree_input, kw_ret \
-                        = self._convert_batch(turn_batch, prev_z,prev_z1,prev_z2,prev_z3)
-
-                    loss, pr_loss,pr1_loss, pr2_loss, pr3_loss, m_loss, turn_states = self.m(u_input=u_input, z_input=z_input,z1_input=z1_input,z2_input=z2_input,z3_input=z3_input,
-                                                                        m_input=m_input,
-                                                                        degree_input=degree_input,
-                                                                        u_input_np=u_input_np,
-                                                                        m_input_np=m_input_np,
-                                                                        turn_states=turn_states,
-                                                                        u_len=u_len, m_len=m_len, mode='train', **kw_ret)
-                    loss.backward(retain_graph=turn_num != len(dial_batch) - 1)
-                    #grad = torch.nn.utils.clip_grad_norm(self.m.parameters(), 5.0)
-                    grad = torch.nn.utils.clip_grad_norm_(self.m.parameters(), 5.0)
+            data_iterator = self._prefetch('train', turn_parallel=cfg.turn_parallel)
+            try:
+                for iter_num, (plan_batch, converted) in enumerate(data_iterator):
+                    dial_batch = [turn['batch'] for turn in plan_batch]
+                    if cfg.turn_parallel:
+                        turn_losses = self._train_turn_parallel(converted, optim)
+                        sup_loss += sum(turn_losses)
+                        sup_cnt += len(turn_losses)
+                        turn_groups += len(converted)
+                        continue
+                    turn_states = {}
+                    for turn_num, plan_turn in enumerate(plan_batch):
+                        turn_batch = plan_turn['batch']
+                        if cfg.truncated:
+                            logging.debug('iter %d turn %d' % (iter_num, turn_num))
+                        optim.zero_grad()
+                        u_input, u_input_np, z_input,z1_input,z2_input,z3_input, m_input, m_input_np, u_len, \
+                        m_len, degree_input, kw_ret \
+                            = converted[turn_num]
+
+                        loss, pr_loss,pr1_loss, pr2_loss, pr3_loss, m_loss, turn_states = self.m(u_input=u_input, z_input=z_input,z1_input=z1_input,z2_input=z2_input,z3_input=z3_input,
+                                                                            m_input=m_input,
+                                                                            degree_input=degree_input,
+                                                                            u_input_np=u_input_np,
+                                                                            m_input_np=m_input_np,
+                                                                            turn_states=turn_states,
+                                                                            u_len=u_len, m_len=m_len, mode='train', **kw_ret)
+                        loss.backward(retain_graph=turn_num != len(dial_batch) - 1)
+                        #grad = torch.nn.utils.clip_grad_norm(self.m.parameters(), 5.0)
+                        grad = torch.nn.utils.clip_grad_norm_(self.m.parameters(), 5.0)
                     
-                    optim.step()
-                    sup_loss += loss.item()
-                    sup_cnt += 1
-                    logging.debug(
-                        'loss:{} pr_loss:{} pr1_loss:{} pr2_loss:{} pr3_loss:{} m_loss:{} grad:{}'.format(loss.item(),
-                                                                       pr_loss.item(),
-                                                                       pr1_loss.item(),
-                                                                       pr2_loss.item(),
-                                                                       pr3_loss.item(),
-                                                                       m_loss.item(),
-                                                                       grad))
-                    # print(
-                    #     'loss:{} pr_loss:{} pr1_loss:{} pr2_loss:{} pr3_loss:{} m_loss:{} grad:{}'.format(loss.item(),
-                    #                                                    pr_loss.item(),
-                    #                                                    pr1_loss.item(),
-                    #                                                    pr2_loss.item(),
-                    #                                                    pr3_loss.item(),
-                    #                                                    m_loss.item(),
-                    #                                                    grad))
-
-                    prev_z = turn_batch['bspan']
-
+                        optim.step()
+                        sup_loss += loss.item()
+                        sup_cnt += 1
+                        logging.debug(
+                            'loss:{} pr_loss:{} pr1_loss:{} pr2_loss:{} pr3_loss:{} m_loss:{} grad:{}'.format(loss.item(),
+                                                                           pr_loss.item(),
+                                                                           pr1_loss.item(),
+                                                                           pr2_loss.item(),
+                                                                           pr3_loss.item(),
+                                                                           m_loss.item(),
+                                                                           grad))
+                        # print(
+                        #     'loss:{} pr_loss:{} pr1_loss:{} pr2_loss:{} pr3_loss:{} m_loss:{} grad:{}'.format(loss.item(),
+                        #                                                    pr_loss.item(),
+                        #                                                    pr1_loss.item(),
+                        #                                                    pr2_loss.item(),
+                        #                                                    pr3_loss.item(),
+                        #                                                    m_loss.item(),
+                        #                                                    grad))
+            finally:
+                data_iterator.close()
+
+            if cfg.turn_parallel:
+                logging.info('turn-parallel in epoch %d: %d turns in %d groups' % (epoch, sup_cnt, turn_groups))
             epoch_sup_loss = sup_loss / (sup_cnt + 1e-8)
             train_time += time.time() - sw
             logging.info('Traning time: {}'.format(train_time))
@@ -255,54 +379,66 @@ class Model:
         #print("aaaaaaaaaaaaaaaa")
         self.m.eval()
         self.reader.result_file = None
-        data_iterator = self.reader.mini_batch_iterator(data)
+        data_iterator = self._prefetch(data, with_prev_z=False)
         mode = 'test' if not cfg.pretrain else 'pretrain_test'
-        for batch_num, dial_batch in enumerate(data_iterator):
-            turn_states = {}
-            prev_z = None
-            prev_z1 = None
-            prev_z2 = None
-            prev_z3 = None
-            for turn_num, turn_batch in enumerate(dial_batch):
-                u_input, u_input_np, z_input,z1_input,z2_input,z3_input, m_input, m_input_np, u_len, \
-                m_len, degree_input, kw_ret \
-                    = self._convert_batch(turn_batch, prev_z,prev_z1,prev_z2,prev_z3)
-                m_idx, z_idx,z1_idx, z2_idx, z3_idx, turn_states = self.m(mode=mode, u_input=u_input, u_len=u_len, z_input=z_input,z1_input=z1_input,z2_input=z2_input,z3_input=z3_input,
-                                                   m_input=m_input,
-                                                   degree_input=degree_input, u_input_np=u_input_np,
-                                                   m_input_np=m_input_np, m_len=m_len, turn_states=turn_states,
-                                                   dial_id=turn_batch['dial_id'], **kw_ret)
-                self.reader.wrap_result(turn_batch, m_idx, z_idx, z1_idx, z2_idx, z3_idx, prev_z=prev_z)
-                greedy = []
-                i = 0
-                # for i in range(len(z1_idx)):
-                #     temp = []
-                #     for ip in z1_idx[i]:
-                #         if ip != self.reader.vocab.encode("EOS_Z1"):
-                #             temp.append(ip)
-                #         if ip == self.reader.vocab.encode("EOS_Z1"):
-                #             break
-                #     temp.append(self.reader.vocab.encode("EOS_Z1"))
-                #     for ip in z2_idx[i]:
-                #         if ip != self.reader.vocab.encode("EOS_Z2"):
-                #             temp.append(ip)
-                #         if ip == self.reader.vocab.encode("EOS_Z2"):
-                #             break
-                #     temp.append(self.reader.vocab.encode("EOS_Z2"))
-                #     greedy.append(temp)
-                greedy = z1_idx
+        try:
+            for batch_num, (plan_batch, converted) in enumerate(data_iterator):
+                turn_states = {}
+                prev_z = None
+                prev_z1 = None
+                prev_z2 = None
+                prev_z3 = None
+                for turn_num, plan_turn in enumerate(plan_batch):
+                    # the previous bspan is the decoded one, only the other fields are converted ahead
+                    turn_batch = plan_turn['batch']
+                    u_input, u_input_np, z_input,z1_input,z2_input,z3_input, m_input, m_input_np, u_len, \
+                    m_len, degree_input, kw_ret \
+                        = converted[turn_num]
+                    kw_ret = dict(kw_ret)
+                    # dialogs finished at the previous turn are the last rows, they drop out of the batch
+                    size = len(turn_batch['bspan'])
+                    prev_z, prev_z1, prev_z2, prev_z3 = [_[:size] if _ is not None else None
+                                                         for _ in (prev_z, prev_z1, prev_z2, prev_z3)]
+                    self._tensorize_prev_z(self.reader.pad_prev_z(size, prev_z, prev_z1, prev_z2, prev_z3), kw_ret)
+                    m_idx, z_idx,z1_idx, z2_idx, z3_idx, turn_states = self.m(mode=mode, u_input=u_input, u_len=u_len, z_input=z_input,z1_input=z1_input,z2_input=z2_input,z3_input=z3_input,
+                                                       m_input=m_input,
+                                                       degree_input=degree_input, u_input_np=u_input_np,
+                                                       m_input_np=m_input_np, m_len=m_len, turn_states=turn_states,
+                                                       dial_id=turn_batch['dial_id'], **kw_ret)
+                    self.reader.wrap_result(turn_batch, m_idx, z_idx, z1_idx, z2_idx, z3_idx, prev_z=prev_z)
+                    greedy = []
+                    i = 0
+                    # for i in range(len(z1_idx)):
+                    #     temp = []
+                    #     for ip in z1_idx[i]:
+                    #         if ip != self.reader.vocab.encode("EOS_Z1"):
+                    #             temp.append(ip)
+                    #         if ip == self.reader.vocab.encode("EOS_Z1"):
+                    #             break
+                    #     temp.append(self.reader.vocab.encode("EOS_Z1"))
+                    #     for ip in z2_idx[i]:
+                    #         if ip != self.reader.vocab.encode("EOS_Z2"):
+                    #             temp.append(ip)
+                    #         if ip == self.reader.vocab.encode("EOS_Z2"):
+                    #             break
+                    #     temp.append(self.reader.vocab.encode("EOS_Z2"))
+                    #     greedy.append(temp)
+                    greedy = z1_idx
                 
                 
                 
                 
-                if cfg.eval_with_ground_truth is True:
-                    # using ground truth as the B_{t-1} for evaluation.
-                    # with user simulation, we should then change it to greedy approach.
-                    prev_z = turn_batch['bspan'] # XXX warning: we no longer use the 
-                    # previous generated bspan as the input.
-                    # instead, we fetch the ground truth bspan of the prevsiou trun for evaluating the next turn. 
-                else:
-                    prev_z = greedy # greedy approach
+                    if cfg.eval_with_ground_truth is True:
+                        # using ground truth as the B_{t-1} for evaluation.
+                        # with user simulation, we should then change it to greedy approach.
+                        prev_z = turn_batch['bspan'] # XXX warning: we no longer use the 
+                        # previous generated bspan as the input.
+                        # instead, we fetch the ground truth bspan of the prevsiou trun for evaluating the next turn. 
+                    else:
+                        prev_z = greedy # greedy approach
+        finally:
+            data_iterator.close()
+        logging.info('db degree cache: {}'.format(self.reader.degree_cache_info()))
         ev = self.EV(result_path=cfg.result_path)
         res = ev.run_metrics()
         self.m.train()
@@ -310,31 +446,29 @@ class Model:
 
     def validate(self, data='dev'):
         self.m.eval()
-        data_iterator = self.reader.mini_batch_iterator(data)
+        data_iterator = self._prefetch(data)
         sup_loss, unsup_loss = 0, 0
         sup_cnt, unsup_cnt = 0, 0
-        for dial_batch in data_iterator:
-            turn_states = {}
-            prev_z = None
-            for turn_num, turn_batch in enumerate(dial_batch):
-                if prev_z is None:
-                        prev_z = [[self.reader.vocab.encode('EOS_Z1'), self.reader.vocab.encode('EOS_Z2')]] * len(turn_batch['bspan']) # : this is the bspan of all. 
-                    
-                u_input, u_input_np, z_input,z1_input,z2_input,z3_input, m_input, m_input_np, u_len, \
-                m_len, degree_input, kw_ret \
-                    = self._convert_batch(turn_batch,prev_z)
-
-                loss, pr_loss,pr1_loss, pr2_loss, pr3_loss, m_loss, turn_states = self.m(u_input=u_input, z_input=z_input,z1_input=z1_input,z2_input=z2_input,z3_input=z3_input,
-                                                                    m_input=m_input,
-                                                                    turn_states=turn_states,
-                                                                    degree_input=degree_input,
-                                                                    u_input_np=u_input_np, m_input_np=m_input_np,
-                                                                    u_len=u_len, m_len=m_len, mode='train',**kw_ret)
-                sup_loss += loss.item()
-                sup_cnt += 1
-                logging.debug(
-                    'loss:{} pr_loss:{} pr1_loss:{} pr2_loss:{} pr3_loss:{} m_loss:{}'.format(loss.item(), pr_loss.item(), pr1_loss.item(), pr2_loss.item(), pr3_loss.item(), m_loss.item()))
-                prev_z = turn_batch['bspan']
+        try:
+            for plan_batch, converted in data_iterator:
+                turn_states = {}
+                for turn_num, plan_turn in enumerate(plan_batch):
+                    u_input, u_input_np, z_input,z1_input,z2_input,z3_input, m_input, m_input_np, u_len, \
+                    m_len, degree_input, kw_ret \
+                        = converted[turn_num]
+
+                    loss, pr_loss,pr1_loss, pr2_loss, pr3_loss, m_loss, turn_states = self.m(u_input=u_input, z_input=z_input,z1_input=z1_input,z2_input=z2_input,z3_input=z3_input,
+                                                                        m_input=m_input,
+                                                                        turn_states=turn_states,
+                                                                        degree_input=degree_input,
+                                                                        u_input_np=u_input_np, m_input_np=m_input_np,
+                                                                        u_len=u_len, m_len=m_len, mode='train',**kw_ret)
+                    sup_loss += loss.item()
+                    sup_cnt += 1
+                    logging.debug(
+                        'loss:{} pr_loss:{} pr1_loss:{} pr2_loss:{} pr3_loss:{} m_loss:{}'.format(loss.item(), pr_loss.item(), pr1_loss.item(), pr2_loss.item(), pr3_loss.item(), m_loss.item()))
+        finally:
+            data_iterator.close()
         sup_loss /= (sup_cnt + 1e-8)
         unsup_loss /= (unsup_cnt + 1e-8)
         self.m.train()
@@ -352,38 +486,36 @@ class Model:
             if epoch <= self.base_epoch:
                 continue
             epoch_loss, cnt = 0,0
-            data_iterator = self.reader.mini_batch_iterator('train')
+            data_iterator = self._prefetch('train')
             optim = self.optim #Adam(lr=lr, params=filter(lambda x: x.requires_grad, self.m.parameters()), weight_decay=0)
-            for iter_num, dial_batch in enumerate(data_iterator):
-                turn_states = {}
-                prev_z = None
-                prev_z1 = None
-                prev_z2 = None
-                prev_z3 = None
-                for turn_num, turn_batch in enumerate(dial_batch):
-                    optim.zero_grad()
-                    u_input, u_input_np, z_input,z1_input,z2_input,z3_input, m_input, m_input_np, u_len, \
-                    m_len, degree_input, kw_ret \
-                        = self._convert_batch(turn_batch, prev_z,prev_z1,prev_z2,prev_z3)
-                    loss_rl = self.m(u_input=u_input, z_input=z_input,z1_input=z1_input,z2_input=z2_input,z3_input=z3_input,
-                                m_input=m_input,
-                                degree_input=degree_input,
-                                u_input_np=u_input_np,
-                                m_input_np=m_input_np,
-                                turn_states=turn_states,
-                                dial_id=turn_batch['dial_id'],
-                                u_len=u_len, m_len=m_len, mode=mode, **kw_ret)
-
-                    if loss_rl is not None:
-                        loss = loss_rl #+ loss_mle * 0.1
-                        loss.backward()
-                        grad = torch.nn.utils.clip_grad_norm(self.m.parameters(), 2.0)
-                        optim.step()
-                        epoch_loss += loss.data.cpu().numpy()[0]
-                        cnt += 1
-                        logging.debug('{} loss {}, grad:{}'.format(mode,loss.data[0],grad))
-
-                    prev_z = turn_batch['bspan']
+            try:
+                for iter_num, (plan_batch, converted) in enumerate(data_iterator):
+                    turn_states = {}
+                    for turn_num, plan_turn in enumerate(plan_batch):
+                        turn_batch = plan_turn['batch']
+                        optim.zero_grad()
+                        u_input, u_input_np, z_input,z1_input,z2_input,z3_input, m_input, m_input_np, u_len, \
+                        m_len, degree_input, kw_ret \
+                            = converted[turn_num]
+                        loss_rl = self.m(u_input=u_input, z_input=z_input,z1_input=z1_input,z2_input=z2_input,z3_input=z3_input,
+                                    m_input=m_input,
+                                    degree_input=degree_input,
+                                    u_input_np=u_input_np,
+                                    m_input_np=m_input_np,
+                                    turn_states=turn_states,
+                                    dial_id=turn_batch['dial_id'],
+                                    u_len=u_len, m_len=m_len, mode=mode, **kw_ret)
+
+                        if loss_rl is not None:
+                            loss = loss_rl #+ loss_mle * 0.1
+                            loss.backward()
+                            grad = torch.nn.utils.clip_grad_norm(self.m.parameters(), 2.0)
+                            optim.step()
+                            epoch_loss += loss.data.cpu().numpy()[0]
+                            cnt += 1
+                            logging.debug('{} loss {}, grad:{}'.format(mode,loss.data[0],grad))
+            finally:
+                data_iterator.close()
 
             epoch_sup_loss = epoch_loss / (cnt + 1e-8)
             logging.info('avg training loss in epoch %d sup:%f' % (epoch, epoch_sup_loss))
@@ -502,6 +634,8 @@ def main():
     elif args.mode == 'rl':
         m.load_model()
         m.reinforce_tune()
+    elif args.mode == 'bench_db':
+        m.reader.benchmark_db_degree()
 
 
 if __name__ == '__main__':
@@ -12,7 +12,12 @@ import os
 import re
 import csv
 import time, datetime
+import functools
+import itertools
+import hashlib
 import pickle
+import multiprocessing
+import collections
 
 
 def clean_replace(s, r, t, forward=True, backward=False):
@@ -41,6 +46,277 @@ def clean_replace(s, r, t, forward=True, backward=False):
     return s
 
 
+# slot names the response decoder copies from the belief span as their `_SLOT` placeholder
+SELECTIVE_COPY_SLOTS = ['address', 'phone', 'postcode', 'pricerange', 'area']
+
+
+def get_selective_copy_target(vocab, index_list):
+    """
+    map belief span tokens to the word the response decoder copies them as.
+    requestable slot names map to their `_SLOT` placeholder, <unk> and out-of-vocab tokens
+    to -1 (copied by position), every other token to itself.
+    :param vocab: Vocab
+    :param index_list: list of token indexes
+    :return: list of int
+    """
+    targets = []
+    for w, word in zip(index_list, vocab.decode_array(index_list)):
+        w = int(w)
+        if word in SELECTIVE_COPY_SLOTS:
+            targets.append(vocab.encode(word + '_SLOT'))
+        elif w == 2 or w >= cfg.vocab_size:
+            targets.append(-1)
+        else:
+            targets.append(w)
+    return targets
+
+
+class KvretKBIndex:
+    """
+    a dialog KB compiled for KvretReader.db_degree. Constraints map to int bitsets of the items whose joined
+    values contain them; weather items are also indexed by the forecast of each day, see KvretReader.db_match
+    """
+    week = ['sunday', 'monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'today']
+
+    def __init__(self, items):
+        self.items = items
+        self.item_strs = [(i, ' '.join(item.values())) for i, item in enumerate(items)]
+        self.all_bits = (1 << len(items)) - 1
+        self.weather_bits = 0
+        self.day_strs = {day: [] for day in self.week}
+        for i, item in enumerate(items):
+            if 'monday' in item:
+                self.weather_bits |= 1 << i
+                for day in self.week:
+                    forecast = item.get(item.get('today', '')) if day == 'today' else item.get(day)
+                    self.day_strs[day].append((i, (forecast or '') + ' ' + item.get('location', '')))
+        self.bits = {}
+
+    def match_bits(self, constraint, day=None):
+        """
+        items matching a constraint, against the forecast of day when given
+        """
+        bits = self.bits.get((day, constraint))
+        if bits is None:
+            bits = 0
+            for i, item_str in self.item_strs if day is None else self.day_strs[day]:
+                if constraint in item_str:
+                    bits |= 1 << i
+            self.bits[(day, constraint)] = bits
+        return bits
+
+    def count(self, constraints):
+        """
+        :param constraints: list of constraint phrases
+        :return: number of matching items
+        """
+        constraints = set(constraints)
+        week_cons = constraints.intersection(self.week)
+        weather_cnt, bits = 0, self.all_bits
+        if week_cons and self.weather_bits:
+            day = list(week_cons)[0]
+            weather_bits = self.weather_bits
+            for c in constraints.difference(self.week).difference(['temperature']):
+                weather_bits &= self.match_bits(c, day)
+            weather_cnt = bin(weather_bits).count('1')
+            bits &= ~self.weather_bits
+        for c in constraints:
+            if not bits:
+                break
+            bits &= self.match_bits(c)
+        return weather_cnt + bin(bits).count('1')
+
+
+class EntityMatcher:
+    """
+    an entity map compiled into an Aho-Corasick automaton, finding every value that occurs in a string in one
+    pass over it. Values are ranked in the order the entity replacement loops try them in.
+    """
+
+    def __init__(self, value_map, longest_first=True):
+        """
+        :param value_map: dict of value string to entity key
+        :param longest_first: rank values longest first, otherwise in the order of value_map
+        """
+        self.entries = sorted(value_map.items(), key=lambda x: -len(x[0])) if longest_first \
+            else list(value_map.items())
+        self.goto, self.fail, self.out = [{}], [0], [[]]
+        self.always = []  # ranks of the empty value, found in every string
+        for rank, (v, k) in enumerate(self.entries):
+            if not v:
+                self.always.append(rank)
+                continue
+            node = 0
+            for c in v:
+                if c not in self.goto[node]:
+                    self.goto[node][c] = len(self.goto)
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append([])
+                node = self.goto[node][c]
+            self.out[node].append(rank)
+        queue = collections.deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for c, child in self.goto[node].items():
+                queue.append(child)
+                f = self.fail[node]
+                while f and c not in self.goto[f]:
+                    f = self.fail[f]
+                if node:
+                    self.fail[child] = self.goto[f].get(c, 0)
+                self.out[child] = self.out[child] + self.out[self.fail[child]]
+
+    def ranks(self, s):
+        """
+        :return: sorted ranks of the values occurring in s
+        """
+        goto, fail, out = self.goto, self.fail, self.out
+        found = set(self.always)
+        node = 0
+        for c in s:
+            while node and c not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(c, 0)
+            if out[node]:
+                found.update(out[node])
+        return sorted(found)
+
+    def replace(self, s, replace_fn):
+        """
+        call s = replace_fn(s, value, key) for the values occurring in s, by rank. s is scanned again after
+        every call that changes it, so values are tried exactly as by a loop calling replace_fn on every entry
+        the current s contains.
+        :return: s after the last replacement
+        """
+        ranks, i = self.ranks(s), 0
+        while i < len(ranks):
+            rank = ranks[i]
+            new_s = replace_fn(s, *self.entries[rank])
+            if new_s != s:
+                s = new_s
+                ranks, i = [_ for _ in self.ranks(s) if _ > rank], 0
+            else:
+                i += 1
+        return s
+
+
+class FlatDialogs:
+    """
+    a read-only sequence of encoded dialogs kept in flat columns: the token lists of a turn field are
+    concatenated into one int32 array with an offset array, the degree vectors form a float32 matrix and
+    every int field is an array over turns, with dialogs indexed by turn offsets. Dialogs are built as lists
+    of turn dicts when accessed. The columns are saved as .npy files and loaded memory-mapped, so processes
+    reading the same files share them. Slicing and shuffle only change the dialogs the sequence selects.
+    """
+
+    def __init__(self, columns, fields, index=None):
+        """
+        :param columns: dict of column name to numpy array, see from_dialogs
+        :param fields: list of (turn field, 'tokens' / 'vector' / 'int') in the key order of a turn
+        :param index: list of the selected dialogs, all by default
+        """
+        self.columns = columns
+        self.fields = fields
+        self.index = list(range(len(columns['dial_offsets']) - 1)) if index is None else index
+
+    @staticmethod
+    def _field_kind(value):
+        if isinstance(value, int):
+            return 'int'
+        elif value and isinstance(value[0], float):
+            return 'vector'
+        return 'tokens'
+
+    @classmethod
+    def from_dialogs(cls, dials):
+        """
+        :param dials: list of dialogs, lists of turn dicts that all have the fields and field kinds of the first turn
+        :raise ValueError: if a turn has other fields, or a field of another kind, than the first turn
+        """
+        turns = [turn for dial in dials for turn in dial]
+        fields = [(k, cls._field_kind(v)) for k, v in (turns[0].items() if turns else [])]
+        for turn_idx, turn in enumerate(turns):
+            if set(turn.keys()) != set(k for k, _ in fields):
+                raise ValueError('turn %d has fields %s, expected %s' %
+                                 (turn_idx, list(turn.keys()), [k for k, _ in fields]))
+            for k, kind in fields:
+                if cls._field_kind(turn[k]) != kind:
+                    raise ValueError('field %s of turn %d is %s, expected %s' %
+                                     (k, turn_idx, cls._field_kind(turn[k]), kind))
+        columns = {'dial_offsets': np.cumsum([0] + [len(dial) for dial in dials], dtype=np.int64)}
+        for k, kind in fields:
+            if kind == 'int':
+                columns[k] = np.array([turn[k] for turn in turns], dtype=np.int64)
+            elif kind == 'vector':
+                columns[k] = np.array([turn[k] for turn in turns], dtype=np.float32)
+            else:
+                columns[k + '_offsets'] = np.cumsum([0] + [len(turn[k]) for turn in turns], dtype=np.int64)
+                columns[k] = np.fromiter(itertools.chain.from_iterable(turn[k] for turn in turns), dtype=np.int32,
+                                         count=int(columns[k + '_offsets'][-1]))
+        return cls(columns, fields)
+
+    def save(self, path):
+        """
+        save all dialogs, whatever the selection, as one .npy file per column in directory path
+        """
+        os.makedirs(path, exist_ok=True)
+        for name, column in self.columns.items():
+            np.save(os.path.join(path, name + '.npy'), column)
+        with open(os.path.join(path, 'fields.json'), 'w') as f:
+            json.dump(self.fields, f)
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        with open(os.path.join(path, 'fields.json')) as f:
+            fields = [tuple(_) for _ in json.load(f)]
+        names = ['dial_offsets'] + [k + suffix for k, kind in fields
+                                    for suffix in (['_offsets', ''] if kind == 'tokens' else [''])]
+        columns = {name: np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode) for name in names}
+        return cls(columns, fields)
+
+    def shuffle(self):
+        """
+        shuffle the order of the dialogs, drawing the same random numbers as random.shuffle of a list
+        """
+        random.shuffle(self.index)
+
+    def _dialog(self, dial_idx):
+        dial = []
+        offsets = self.columns['dial_offsets']
+        for t in range(int(offsets[dial_idx]), int(offsets[dial_idx + 1])):
+            turn = {}
+            for k, kind in self.fields:
+                if kind == 'tokens':
+                    token_offsets = self.columns[k + '_offsets']
+                    turn[k] = self.columns[k][token_offsets[t]:token_offsets[t + 1]].tolist()
+                else:
+                    turn[k] = self.columns[k][t].tolist()
+            dial.append(turn)
+        return dial
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return FlatDialogs(self.columns, self.fields, self.index[item])
+        return self._dialog(self.index[item])
+
+    def __iter__(self):
+        for dial_idx in self.index:
+            yield self._dialog(dial_idx)
+
+
+# the dialog tokenizer and its extra arguments, set while a pool of forked workers of _map_dialogs runs
+_tokenize_job = None
+
+
+def _tokenize_shard(shard):
+    tokenize_dial, args = _tokenize_job
+    return [tokenize_dial(dial_id, raw_dial, *args) for dial_id, raw_dial in shard]
+
+
 class _ReaderBase:
     class LabelSet:
         def __init__(self):
@@ -97,6 +373,7 @@ class _ReaderBase:
             self._item2idx = dic['item2idx']
             self._freq_dict = dic['freq_dict']
             f.close()
+            self._build_index()
 
         def save_vocab(self, vocab_path):
             f = open(vocab_path, 'wb')
@@ -108,16 +385,56 @@ class _ReaderBase:
             pickle.dump(dic, f)
             f.close()
 
+        def _build_index(self):
+            """
+            numpy id -> word array behind decode_array, rebuilt when the vocab is loaded or has grown
+            """
+            self._idx2item_arr = np.array([self._idx2item[i] for i in range(len(self))], dtype=object)
+
+        def _item_array(self):
+            if getattr(self, '_idx2item_arr', None) is None or len(self._idx2item_arr) != len(self):
+                self._build_index()
+            return self._idx2item_arr
+
+        def _encode_iter(self, word_list):
+            # the word -> id dict stays the index: a numpy string array of the words costs more to build
+            # than the dict lookups, which map runs without a python-level loop
+            return map(self._item2idx.get, word_list, itertools.repeat(self._item2idx['<unk>']))
+
+        def encode_array(self, word_list):
+            """
+            encode a list of words in one call
+            :return: numpy int64 array
+            """
+            return np.fromiter(self._encode_iter(word_list), dtype=np.int64, count=len(word_list))
+
+        def decode_array(self, index_array):
+            """
+            decode a list, numpy array or tensor of indexes in one call, indexes of the extended vocab
+            decode to ITEM_<position> like decode
+            :return: numpy object array of words, same shape as index_array
+            """
+            if isinstance(index_array, torch.Tensor):
+                index_array = index_array.cpu().numpy()
+            index_array = np.asarray(index_array, dtype=np.int64)
+            items = self._item_array()
+            known = index_array < len(items)
+            words = np.empty(index_array.shape, dtype=object)
+            words[known] = items[index_array[known]]
+            for pos in zip(*np.nonzero(~known)):
+                words[pos] = 'ITEM_%d' % (index_array[pos] - cfg.vocab_size)
+            return words
+
         def sentence_encode(self, word_list):
-            return [self.encode(_) for _ in word_list]
+            return list(self._encode_iter(word_list))
 
         def sentence_decode(self, index_list, eos=None):
-            l = [self.decode(_) for _ in index_list]
-            if not eos or eos not in l:
-                return ' '.join(l)
-            else:
-                idx = l.index(eos)
-                return ' '.join(l[:idx])
+            l = self.decode_array(index_list)
+            if eos:
+                eos_pos = np.flatnonzero(l == eos)
+                if len(eos_pos):
+                    l = l[:eos_pos[0]]
+            return ' '.join(l)
 
         def nl_decode(self, l, eos=None):
             return [self.sentence_decode(_, eos) + '\n' for _ in l]
@@ -131,7 +448,7 @@ class _ReaderBase:
         def decode(self, idx):
             idx1 = idx
             if type(idx) == torch.Tensor:
-                idx1 = idx.cpu().numpy().item()
+                idx1 = idx.item()
             if idx1 < len(self):
                 return self._idx2item[idx1]
             else:
@@ -141,11 +458,97 @@ class _ReaderBase:
         self.train, self.dev, self.test = [], [], []
         self.vocab = self.Vocab()
         self.result_file = ''
+        self._batch_plans = {}
+        self.data_digest = None  # of the input files and config of the encoded data, see _data_digest
+        self._degree_vec = functools.lru_cache(maxsize=cfg.degree_cache_size)(self._get_degree_vec)
+        self._entity_matchers = {}
 
     def _construct(self, *args):
 
         raise NotImplementedError('This is an abstract class, bro')
 
+    def _map_dialogs(self, tokenize_dial, raw_data, *args):
+        """
+        call tokenize_dial(dial_id, raw_dial, *args) on every dialog of raw_data. Shards of dialogs are tokenized
+        by cfg.tokenize_workers forked processes, which see the reader as it is when the pool starts, so
+        tokenize_dial must not change the reader. Results come back in the order of raw_data.
+        :return: list of the results of tokenize_dial
+        """
+        global _tokenize_job
+        dials = list(enumerate(raw_data))
+        workers = min(cfg.tokenize_workers, len(dials))
+        if workers <= 1 or 'fork' not in multiprocessing.get_all_start_methods():
+            return [tokenize_dial(dial_id, raw_dial, *args) for dial_id, raw_dial in dials]
+        shard_size = -(-len(dials) // (workers * 4))
+        shards = [dials[i:i + shard_size] for i in range(0, len(dials), shard_size)]
+        _tokenize_job = (tokenize_dial, args)
+        try:
+            with multiprocessing.get_context('fork').Pool(workers) as pool:
+                results = pool.map(_tokenize_shard, shards)
+        finally:
+            _tokenize_job = None
+        return [_ for shard in results for _ in shard]
+
+    def _get_entity_matcher(self, value_map):
+        """
+        the EntityMatcher of a value map, compiled the first time the map is seen
+        """
+        matcher = self._entity_matchers.get(id(value_map))
+        if matcher is None or matcher[0] is not value_map:
+            matcher = (value_map, EntityMatcher(value_map))
+            self._entity_matchers[id(value_map)] = matcher
+        return matcher[1]
+
+    def _data_digest(self, data_paths, options):
+        """
+        hash of the input files, the vocab file and the config the encoding depends on, so that a change of any
+        of them misses the caches keyed by it
+        """
+        md5 = hashlib.md5()
+        for path in list(data_paths) + [cfg.vocab_path]:
+            with open(path, 'rb') as f:
+                md5.update(f.read())
+        md5.update(pickle.dumps(options))
+        return md5.hexdigest()
+
+    def _data_cache_path(self, digest):
+        """
+        file of the encoded data of a dataset, named by its _data_digest
+        :return: path in cfg.cache_dir, None if cfg.cache_dir is ''
+        """
+        if not cfg.cache_dir:
+            return None
+        return os.path.join(cfg.cache_dir, 'encoded_data-%s' % digest)
+
+    def _load_cached_data(self, path):
+        """
+        the data saved by _save_cached_data, the splits memory-mapped
+        :return: (dict of split name to FlatDialogs, extra data), None if nothing is cached at path
+        """
+        meta_path = os.path.join(path, 'meta.pkl') if path else None
+        if not meta_path or not os.path.isfile(meta_path):
+            return None
+        logging.info('loading encoded data %s' % path)
+        with open(meta_path, 'rb') as f:
+            names, meta = pickle.load(f)
+        return {name: FlatDialogs.load(os.path.join(path, name)) for name in names}, meta
+
+    def _save_cached_data(self, path, splits, meta=None):
+        """
+        flatten the encoded splits and save them with extra data in directory path, if path is set
+        :param splits: dict of split name to list of dialogs
+        :return: same as _load_cached_data
+        """
+        splits = {name: FlatDialogs.from_dialogs(dials) for name, dials in splits.items()}
+        if not path:
+            return splits, meta
+        for name, dials in splits.items():
+            dials.save(os.path.join(path, name))
+        # written last, a directory without it is an interrupted save
+        with open(os.path.join(path, 'meta.pkl'), 'wb') as f:
+            pickle.dump((list(splits), meta), f, protocol=pickle.HIGHEST_PROTOCOL)
+        return self._load_cached_data(path)
+
     def _bucket_by_turn(self, encoded_data):
         turn_bucket = {}
         for dial in encoded_data:
@@ -188,12 +591,63 @@ class _ReaderBase:
             all_batches.append(batch)
         return all_batches
 
+    def _construct_token_batch(self, data):
+        """
+        cut dialogs with the same number of turns into batches of at most cfg.batch_tokens padded user,
+        response and bspan tokens. A dialog over the budget on its own gets a batch of its own.
+        """
+        all_batches = []
+        batch, turn_max = [], None
+        for dial in data:
+            lens = np.array([[turn['u_len'], turn['m_len'], len(turn['bspan'])] for turn in dial])
+            new_max = lens if turn_max is None else np.maximum(turn_max, lens)
+            if batch and (len(batch) + 1) * new_max.sum() > cfg.batch_tokens:
+                all_batches.append(batch)
+                batch, new_max = [], lens
+            batch.append(dial)
+            turn_max = new_max
+        if batch:
+            all_batches.append(batch)
+        return all_batches
+
+    def _dial_tokens(self, dial):
+        """
+        number of user, response and bspan tokens of a dialog
+        """
+        return sum(turn['u_len'] + turn['m_len'] + len(turn['bspan']) for turn in dial)
+
+    def _batch_dialogs(self, dials):
+        """
+        split the dialogs of a turn-count bucket into mini-batches, in the way selected by cfg.batch_mode:
+        'turn' keeps the data order, 'length' sorts the dialogs by their number of tokens first so that
+        dialogs of similar length share a batch and less padding goes through the model, 'token' sorts them
+        too and caps every batch by padded tokens instead of cfg.batch_size, 'masked' keeps the order of a
+        bucket holding the whole split sorted by number of turns, see _build_batch_plan
+        """
+        if cfg.batch_mode == 'token':
+            return self._construct_token_batch(sorted(dials, key=self._dial_tokens))
+        if cfg.batch_mode == 'length':
+            dials = sorted(dials, key=self._dial_tokens)
+        elif cfg.batch_mode not in ['turn', 'masked']:
+            raise ValueError('batch mode "%s" not understood' % cfg.batch_mode)
+        return self._construct_mini_batch(dials)
+
     def _transpose_batch(self, batch):
+        """
+        turn a batch of dialogs into a list of turn batches. Dialogs are ordered by number of turns, the
+        longest first, so the dialogs still active at a turn are the first rows of the batch and the finished
+        ones are left out of the turn batch. Rows of a batch of dialogs of one length keep their order.
+        :param batch: list of dialogs, each a list of turns
+        :return: list of dicts of lists, one per turn
+        """
+        batch = sorted(batch, key=len, reverse=True)
         dial_batch = []
         turn_num = len(batch[0])
         for turn in range(turn_num):
             turn_l = {}
             for dial in batch:
+                if len(dial) <= turn:
+                    break
                 this_turn = dial[turn]
                 for k in this_turn:
                     if k not in turn_l:
@@ -202,19 +656,152 @@ class _ReaderBase:
             dial_batch.append(turn_l)
         return dial_batch
 
-    def mini_batch_iterator(self, set_name):
+    def pad_turn_batch(self, turn_batch):
+        """
+        pad the fields of a turn batch that do not depend on the previous bspan
+        :param turn_batch: dict of lists, see _transpose_batch
+        :return: dict of numpy arrays, sequences in time-major [T,B] layout
+        """
+        arrays = {
+            'u_input_np': pad_sequences(turn_batch['user'], cfg.max_ts, padding='post', truncating='pre',
+                                        time_major=True),
+            'z_input_np': pad_sequences(turn_batch['bspan'], padding='post', time_major=True),
+            'z2_input_np': pad_sequences(turn_batch['user_tag'], padding='post', time_major=True),
+            'z3_input_np': pad_sequences(turn_batch['system'], padding='post', time_major=True),
+            'm_input_np': pad_sequences(turn_batch['response'], cfg.max_ts, padding='post', truncating='post',
+                                        time_major=True),
+            'u_len': np.array(turn_batch['u_len']),
+            'm_len': np.array(turn_batch['m_len']),
+            'degree_input_np': np.array(turn_batch['degree']),
+        }
+        arrays['z1_input_np'] = arrays['z_input_np']
+        if 'bspan_copy' in turn_batch:
+            arrays['z_copy_np'] = pad_sequences(turn_batch['bspan_copy'], padding='post', time_major=True)
+        return arrays
+
+    def pad_prev_z(self, batch_size, prev_z_py=None, prev_z1_py=None, prev_z2_py=None, prev_z3_py=None):
+        """
+        pad the previous bspans of a turn batch, the empty bspan is used for the ones not given.
+        The previous bspan is cut after its first EOS_Z2 and copied words are replaced by <unk> in place.
+        :return: dict of numpy arrays, sequences in time-major [T,B] layout
+        """
+        if prev_z_py is None:
+            prev_z_py = [[self.vocab.encode('EOS_Z1'), self.vocab.encode('EOS_Z2')]] * batch_size
+        if prev_z1_py is None:
+            prev_z1_py = [[self.vocab.encode('EOS_Z1')]] * batch_size
+        if prev_z2_py is None:
+            prev_z2_py = [[self.vocab.encode('EOS_Z2')]] * batch_size
+        if prev_z3_py is None:
+            prev_z3_py = [[self.vocab.encode('<split>')]] * batch_size
+        arrays = {}
+        for key, prev, eob in [('prev_z', prev_z_py, 'EOS_Z2'), ('prev_z1', prev_z1_py, 'EOS_Z1'),
+                               ('prev_z2', prev_z2_py, 'EOS_Z2'), ('prev_z3', prev_z3_py, '<split>')]:
+            eob = self.vocab.encode(eob)
+            for i in range(len(prev)):
+                if eob in prev[i] and prev[i].index(eob) != len(prev[i]) - 1:
+                    idx = prev[i].index(eob)
+                    prev[i] = prev[i][:idx + 1]
+                if key == 'prev_z':
+                    for j, word in enumerate(prev[i]):
+                        if word >= cfg.vocab_size:
+                            prev[i][j] = 2  # unk
+            arrays[key + '_input_np'] = pad_sequences(prev, cfg.max_ts, padding='post', truncating='pre',
+                                                      time_major=True)
+            arrays[key + '_len'] = np.array([len(_) for _ in prev])
+        return arrays
+
+    def _build_batch_plan(self, set_name):
+        """
+        bucket, batch, pad and mark a split once. Every turn of the plan keeps its turn batch, its padded
+        fields and the padded ground truth bspan of the previous turn.
+        :return: list of batches, each a list of turns
+        """
         name_to_set = {'train': self.train, 'test': self.test, 'dev': self.dev}
         dial = name_to_set[set_name]
-        turn_bucket = self._bucket_by_turn(dial)
-        # self._shuffle_turn_bucket(turn_bucket)
+        if cfg.batch_mode == 'masked':
+            # dialogs of any turn count share a batch, the longest first, see _transpose_batch
+            turn_bucket = {0: sorted(dial, key=len, reverse=True)}
+        else:
+            turn_bucket = self._bucket_by_turn(dial)
         all_batches = []
         for k in turn_bucket:
-            batches = self._construct_mini_batch(turn_bucket[k])
+            batches = self._batch_dialogs(turn_bucket[k])
             all_batches += batches
         self._mark_batch_as_supervised(all_batches)
-        random.shuffle(all_batches)
-        for i, batch in enumerate(all_batches):
-            yield self._transpose_batch(batch)
+        plan = []
+        for batch in all_batches:
+            dial_batch = self._transpose_batch(batch)
+            plan_batch = []
+            for turn_num, turn_batch in enumerate(dial_batch):
+                size = len(turn_batch['bspan'])
+                prev_z = [list(_) for _ in dial_batch[turn_num - 1]['bspan'][:size]] if turn_num else None
+                plan_batch.append({
+                    'batch': turn_batch,
+                    'arrays': self.pad_turn_batch(turn_batch),
+                    'prev_arrays': self.pad_prev_z(size, prev_z),
+                })
+            plan.append(plan_batch)
+        return plan
+
+    def _batch_plan_path(self, set_name):
+        """
+        file of the plan of a split, named by a hash of the data digest, the order of the split dialogs in the
+        encoded data and the config the plan depends on
+        :return: path in cfg.batch_plan_dir, None if it is '' or the split does not come from encoded data
+        """
+        name_to_set = {'train': self.train, 'test': self.test, 'dev': self.dev}
+        dials = name_to_set[set_name]
+        if not cfg.batch_plan_dir or self.data_digest is None or not isinstance(dials, FlatDialogs):
+            return None
+        options = (cfg.batch_size, cfg.batch_mode, cfg.batch_tokens, cfg.spv_proportion, cfg.degree_size, cfg.max_ts, cfg.truncated,
+                   cfg.vocab_size)
+        digest = hashlib.md5(pickle.dumps((self.data_digest, set_name, dials.index, options))).hexdigest()
+        return os.path.join(cfg.batch_plan_dir, 'batch_plan-%s-%s.pkl' % (set_name, digest))
+
+    def get_batch_plan(self, set_name):
+        """
+        the batch plan of a split, built on first use and loaded from / saved to cfg.batch_plan_dir if set
+        """
+        if set_name in self._batch_plans:
+            return self._batch_plans[set_name]
+        path = self._batch_plan_path(set_name)
+        if path and os.path.isfile(path):
+            logging.info('loading batch plan %s' % path)
+            with open(path, 'rb') as f:
+                plan = pickle.load(f)
+        else:
+            plan = self._build_batch_plan(set_name)
+            if path:
+                os.makedirs(cfg.batch_plan_dir, exist_ok=True)
+                with open(path, 'wb') as f:
+                    pickle.dump(plan, f, protocol=pickle.HIGHEST_PROTOCOL)
+        self._batch_plans[set_name] = plan
+        return plan
+
+    def padding_efficiency(self, set_name):
+        """
+        share of the padded user, response and bspan positions of a split plan that hold real tokens
+        """
+        real, padded = 0, 0
+        for plan_batch in self.get_batch_plan(set_name):
+            for turn in plan_batch:
+                for key in ['u_input_np', 'm_input_np', 'z_input_np']:
+                    real += np.count_nonzero(turn['arrays'][key])
+                    padded += turn['arrays'][key].size
+        return real / max(padded, 1)
+
+    def batch_plan_iterator(self, set_name):
+        """
+        iterate over the batches of a split plan in a random order
+        """
+        plan = list(self.get_batch_plan(set_name))
+        random.shuffle(plan)
+        for plan_batch in plan:
+            yield plan_batch
+
+    def mini_batch_iterator(self, set_name):
+        for plan_batch in self.batch_plan_iterator(set_name):
+            yield [turn['batch'] for turn in plan_batch]
 
     def wrap_result(self, turn_batch, gen_m, gen_z,gen_z1,gen_z2,gen_z3, eos_syntax=None, prev_z=None):
         """
@@ -307,6 +894,15 @@ class _ReaderBase:
     def db_search(self, constraints):
         raise NotImplementedError('This is an abstract method')
 
+    def benchmark_db_degree(self):
+        raise NotImplementedError('This is an abstract method')
+
+    def db_count(self, constraints):
+        """
+        number of entries db_search would return
+        """
+        return len(self.db_search(constraints))
+
     def db_degree_handler(self, z_samples, *args, **kwargs):
         """
         returns degree of database searching and it may be used to control further decoding.
@@ -317,20 +913,40 @@ class _ReaderBase:
         control_vec = []
 
         for cons_idx_list in z_samples:
-            constraints = set()
-            for cons in cons_idx_list:
-                if type(cons) is not str:
-                    cons = self.vocab.decode(cons)
-                if cons == 'EOS_Z1':
-                    break
-                constraints.add(cons)
-            match_result = self.db_search(constraints)
-            degree = len(match_result)
-            # modified
-            # degree = 0
-            control_vec.append(self._degree_vec_mapping(degree))
+            control_vec.append(self._degree_vec(None, self._constraint_key(cons_idx_list)))
         return np.array(control_vec)
 
+    def _constraint_key(self, cons_idx_list):
+        """
+        the constraints of a bspan as a hashable key of token ids (or strings), without decoding them
+        """
+        eos_idx = self.vocab.encode('EOS_Z1')
+        key = []
+        for cons in cons_idx_list:
+            if type(cons) is not str:
+                cons = int(cons)
+            if cons == eos_idx or cons == 'EOS_Z1':
+                break
+            key.append(cons)
+        return frozenset(key)
+
+    def _decode_constraint_key(self, cons_key):
+        return set(cons if type(cons) is str else self.vocab.decode(cons) for cons in cons_key)
+
+    def _get_degree_vec(self, db_key, cons_key):
+        """
+        degree vector of a constraint key, memoized by _degree_vec
+        :param db_key: identifies the database searched, None for a reader with a single database
+        """
+        degree = self.db_count(self._decode_constraint_key(cons_key))
+        return tuple(self._degree_vec_mapping(degree))
+
+    def degree_cache_info(self):
+        """
+        hits, misses and size of the degree vector cache
+        """
+        return self._degree_vec.cache_info()
+
     def _degree_vec_mapping(self, match_num):
         l = [0.] * cfg.degree_size
         l[min(cfg.degree_size - 1, match_num)] = 1.
@@ -346,74 +962,80 @@ class CamRest676Reader(_ReaderBase):
         self.result_file = ''
 
     def _get_tokenized_data(self, raw_data, db_data, construct_vocab):
-        tokenized_data = []
         vk_map = self._value_key_map(db_data)
-        # count_noun = 0
-        # total_count = 0
-        for dial_id, dial in enumerate(raw_data):
-            tokenized_dial = []
-            i_turn = 0
-            for turn in dial['dial']:
-                i_turn+=1
-                turn_num = turn['turn']
-                constraint = []
-                requested = []
-                for slot in turn['usr']['slu']:
-                    if slot['act'] == 'inform':
-                        s = slot['slots'][0][1]
-                        if s not in ['dontcare', 'none']:
-                            constraint.extend(word_tokenize(s))
-                    else:
-                        requested.extend(word_tokenize(slot['slots'][0][1]))
-                future = []
-                for item in turn['sys']["da"]:
-                    try:
-                        future.extend(word_tokenize(item))
-                    except TypeError:
-                        continue
-                degree = len(self.db_search(constraint))
-                requested = sorted(requested)
-                constraint.append('EOS_Z1')
-                requested.append('EOS_Z2')
-                future.append('<split>')
-                user = word_tokenize(turn['usr']['transcript']) + ['EOS_U']
-                response,slot_list = self._replace_entity(turn['sys']['sent'], vk_map, constraint)
-                
-                ev = self.ev_dummy
-                save_response = response
-                
-                _ , slot_list2 =  ev.clean(response,ifreader=True)
-                # if len(slot_list2) > 0:
-                #     print('response', response)
-                #     #print('save response', save_response)
-                #     print(slot_list2)
-                
-                response = word_tokenize(response) + ['EOS_M']
-                future = slot_list+slot_list2+future
-
-                #if i_turn == len(dial['dial']) and future == ['<split>']:
-                #    future = ['goodbye'] + future
-                #    print("response: ",response)
-                #    print("future: ",future)
-                #total_count +=1
-                # if future == ['<split>']:
-                #     count_noun+=1
-                tokenized_dial.append({
-                    'dial_id': dial_id,
-                    'turn_num': turn_num,
-                    'user': user,
-                    'response': response,
-                    'constraint': constraint,
-                    'requested': requested,
-                    'future':future,
-                    'degree': degree,
-                })
-                if construct_vocab:
-                    for word in user + response + constraint + requested+future:
+        self._get_entity_matcher(vk_map)  # compiled before the workers of _map_dialogs fork
+        tokenized_data = self._map_dialogs(self._tokenize_dial, raw_data, vk_map)
+        if construct_vocab:
+            # words are counted here in dialog order, so the vocab does not depend on the number of workers
+            for tokenized_dial in tokenized_data:
+                for turn in tokenized_dial:
+                    for word in turn['user'] + turn['response'] + turn['constraint'] + turn['requested'] + \
+                            turn['future']:
                         self.vocab.add_item(word)
-            tokenized_data.append(tokenized_dial)
         return tokenized_data
 
+    def _tokenize_dial(self, dial_id, dial, vk_map):
+        # count_noun = 0
+        # total_count = 0
+        tokenized_dial = []
+        i_turn = 0
+        for turn in dial['dial']:
+            i_turn+=1
+            turn_num = turn['turn']
+            constraint = []
+            requested = []
+            for slot in turn['usr']['slu']:
+                if slot['act'] == 'inform':
+                    s = slot['slots'][0][1]
+                    if s not in ['dontcare', 'none']:
+                        constraint.extend(word_tokenize(s))
+                else:
+                    requested.extend(word_tokenize(slot['slots'][0][1]))
+            future = []
+            for item in turn['sys']["da"]:
+                try:
+                    future.extend(word_tokenize(item))
+                except TypeError:
+                    continue
+            degree = self.db_count(constraint)
+            requested = sorted(requested)
+            constraint.append('EOS_Z1')
+            requested.append('EOS_Z2')
+            future.append('<split>')
+            user = word_tokenize(turn['usr']['transcript']) + ['EOS_U']
+            response,slot_list = self._replace_entity(turn['sys']['sent'], vk_map, constraint)
+            
+            ev = self.ev_dummy
+            save_response = response
+            
+            _ , slot_list2 =  ev.clean(response,ifreader=True)
+            # if len(slot_list2) > 0:
+            #     print('response', response)
+            #     #print('save response', save_response)
+            #     print(slot_list2)
+            
+            response = word_tokenize(response) + ['EOS_M']
+            future = slot_list+slot_list2+future
+
+            #if i_turn == len(dial['dial']) and future == ['<split>']:
+            #    future = ['goodbye'] + future
+            #    print("response: ",response)
+            #    print("future: ",future)
+            #total_count +=1
+            # if future == ['<split>']:
+            #     count_noun+=1
+            tokenized_dial.append({
+                'dial_id': dial_id,
+                'turn_num': turn_num,
+                'user': user,
+                'response': response,
+                'constraint': constraint,
+                'requested': requested,
+                'future':future,
+                'degree': degree,
+            })
+        return tokenized_dial
+
     def _replace_entity(self, response, vk_map, constraint):
         slot_list = []
         response,count_post = re.subn('[cC][., ]*[bB][., ]*\d[., ]*\d[., ]*\w[., ]*\w', 'postcode_SLOT', response)
@@ -423,18 +1045,19 @@ class CamRest676Reader(_ReaderBase):
         if count_phone>0:
             slot_list.append('phone_SLOT')
         constraint_str = ' '.join(constraint)
-        for v, k in sorted(vk_map.items(), key=lambda x: -len(x[0])):
+
+        def replace_value(response, v, k):
             start_idx = response.find(v)
-            if start_idx == -1 \
-                    or (start_idx != 0 and response[start_idx - 1] != ' ') \
+            if (start_idx != 0 and response[start_idx - 1] != ' ') \
                     or (v in constraint_str):
-                continue
+                return response
+            slot_list.append(k+'_SLOT')
             if k not in ['name', 'address']:
-                response = clean_replace(response, v, k + '_SLOT', forward=True, backward=False)
-                slot_list.append(k+'_SLOT')
+                return clean_replace(response, v, k + '_SLOT', forward=True, backward=False)
             else:
-                response = clean_replace(response, v, k + '_SLOT', forward=False, backward=False)
-                slot_list.append(k+'_SLOT')
+                return clean_replace(response, v, k + '_SLOT', forward=False, backward=False)
+
+        response = self._get_entity_matcher(vk_map).replace(response, replace_value)
         return response,slot_list
 
     def _value_key_map(self, db_data):
@@ -468,6 +1091,7 @@ class CamRest676Reader(_ReaderBase):
                     'user': prev_response + user,
                     'response': response,
                     'bspan': constraint + requested,
+                    'bspan_copy': get_selective_copy_target(self.vocab, constraint + requested),
                     'u_len': len(prev_response + user),
                     'm_len': len(response),
                     'degree': degree,
@@ -478,8 +1102,6 @@ class CamRest676Reader(_ReaderBase):
                 # modified
                 prev_response = response
             encoded_data.append(encoded_dial)
-        file1 = open('./prepared_data.pkl','wb')
-        pickle.dump(encoded_data,file1,protocol=0)  
         return encoded_data
 
     def _split_data(self, encoded_data, split):
@@ -506,27 +1128,75 @@ class CamRest676Reader(_ReaderBase):
         if not os.path.isfile(cfg.vocab_path):
             construct_vocab = True
             print('Constructing vocab file...')
-        raw_data_json = open(data_json_path)
-        raw_data = json.loads(raw_data_json.read().lower())
         db_json = open(db_json_path)
         db_data = json.loads(db_json.read().lower())
         self.db = db_data
-        tokenized_data = self._get_tokenized_data(raw_data, db_data, construct_vocab)
-        if construct_vocab:
-            self.vocab.construct(cfg.vocab_size)
-            self.vocab.save_vocab(cfg.vocab_path)
-        else:
+        self._build_db_index()
+        cache_files, cache_options = [data_json_path, db_json_path, cfg.entity], ('camrest', cfg.degree_size, cfg.vocab_size)
+        cached = None
+        if not construct_vocab:
             self.vocab.load_vocab(cfg.vocab_path)
-        #encoded_data = pickle.load(open('./prepared_data.pkl','rb'))
-        encoded_data = self._get_encoded_data(tokenized_data)
-        self.train, self.dev, self.test = self._split_data(encoded_data, cfg.split)
-        random.shuffle(self.train)
-        random.shuffle(self.dev)
-        random.shuffle(self.test)
-        raw_data_json.close()
+            self.data_digest = self._data_digest(cache_files, cache_options)
+            cached = self._load_cached_data(self._data_cache_path(self.data_digest))
+        if cached is None:
+            raw_data_json = open(data_json_path)
+            raw_data = json.loads(raw_data_json.read().lower())
+            raw_data_json.close()
+            tokenized_data = self._get_tokenized_data(raw_data, db_data, construct_vocab)
+            if construct_vocab:
+                self.vocab.construct(cfg.vocab_size)
+                self.vocab.save_vocab(cfg.vocab_path)
+            encoded_data = self._get_encoded_data(tokenized_data)
+            self.data_digest = self._data_digest(cache_files, cache_options)
+            cached = self._save_cached_data(self._data_cache_path(self.data_digest),
+                                            {'all': encoded_data})
+        self.train, self.dev, self.test = self._split_data(cached[0]['all'], cfg.split)
+        self.train.shuffle()
+        self.dev.shuffle()
+        self.test.shuffle()
         db_json.close()
 
+    def _build_db_index(self):
+        """
+        index the db by constraint: every constraint maps to an int bitset of the entries whose joined values
+        contain it as a substring. The tokens of all db values are indexed up front, other constraints the
+        first time they are searched.
+        """
+        self.db_values = [' '.join(entry.values()) for entry in self.db]
+        self.db_index = {}
+        for entry_values in self.db_values:
+            for token in entry_values.split():
+                self._db_match_bits(token)
+
+    def _db_match_bits(self, constraint):
+        bits = self.db_index.get(constraint)
+        if bits is None:
+            bits = 0
+            for i, entry_values in enumerate(self.db_values):
+                if constraint in entry_values:
+                    bits |= 1 << i
+            self.db_index[constraint] = bits
+        return bits
+
+    def _db_search_bits(self, constraints):
+        bits = (1 << len(self.db)) - 1
+        for c in constraints:
+            bits &= self._db_match_bits(c)
+            if not bits:
+                break
+        return bits
+
     def db_search(self, constraints):
+        bits = self._db_search_bits(constraints)
+        return [entry for i, entry in enumerate(self.db) if bits >> i & 1]
+
+    def db_count(self, constraints):
+        return bin(self._db_search_bits(constraints)).count('1')
+
+    def _db_search_scan(self, constraints):
+        """
+        db_search by matching the joined values of every entry, kept as the reference of benchmark_db_degree
+        """
         match_results = []
         for entry in self.db:
             entry_values = ' '.join(entry.values())
@@ -539,6 +1209,27 @@ class CamRest676Reader(_ReaderBase):
                 match_results.append(entry)
         return match_results
 
+    def benchmark_db_degree(self):
+        """
+        compute the degree vectors of every test turn with the bitset index and with the entry scan it replaces,
+        log the time of both and the number of turns where they differ
+        :return: number of mismatching turns
+        """
+        turns = [self._decode_constraint_key(self._constraint_key(turn['constraint']))
+                 for dial in self.test for turn in dial]
+        results, times = [], []
+        start = time.time()
+        results.append([self._degree_vec_mapping(len(self._db_search_scan(constraints))) for constraints in turns])
+        times.append(time.time() - start)
+        start = time.time()
+        self._build_db_index()
+        results.append([self._degree_vec_mapping(self.db_count(constraints)) for constraints in turns])
+        times.append(time.time() - start)
+        mismatch = sum(old != new for old, new in zip(*results))
+        logging.info('db degree of %d test turns: scan %.4fs, index %.4fs (incl. build), %d mismatches' %
+                     (len(turns), times[0], times[1], mismatch))
+        return mismatch
+
 
 class KvretReader(_ReaderBase):
     def __init__(self):
@@ -549,8 +1240,8 @@ class KvretReader(_ReaderBase):
 
         self.wn = WordNetLemmatizer()
         self.db = {}
+        self.kb_index = {}
 
-        self.tokenized_data_path = './data/kvret/'
         self._construct(cfg.train, cfg.dev, cfg.test, cfg.entity)
 
     def _construct(self, train_json_path, dev_json_path, test_json_path, entity_json_path):
@@ -558,47 +1249,40 @@ class KvretReader(_ReaderBase):
         if not os.path.isfile(cfg.vocab_path):
             construct_vocab = True
             print('Constructing vocab file...')
-        train_json, dev_json, test_json = open(train_json_path), open(dev_json_path), open(test_json_path)
-        entity_json = open(entity_json_path)
-        train_data, dev_data, test_data = json.loads(train_json.read().lower()), json.loads(dev_json.read().lower()), \
-                                          json.loads(test_json.read().lower())
-        entity_data = json.loads(entity_json.read().lower())
-        self._get_entity_dict(entity_data)
-
-        tokenized_train = self._get_tokenized_data(train_data, construct_vocab, 'train')
-        tokenized_dev = self._get_tokenized_data(dev_data, construct_vocab, 'dev')
-        tokenized_test = self._get_tokenized_data(test_data, construct_vocab, 'test')
-
-        if construct_vocab:
-            self.vocab.construct(cfg.vocab_size)
-            self.vocab.save_vocab(cfg.vocab_path)
-        else:
+        cache_files = [train_json_path, dev_json_path, test_json_path, entity_json_path]
+        cache_options = ('kvret', cfg.intent, cfg.degree_size, cfg.vocab_size)
+        cached = None
+        if not construct_vocab:
             self.vocab.load_vocab(cfg.vocab_path)
-
-        self.train, self.dev, self.test = map(self._get_encoded_data, [tokenized_train, tokenized_dev,
-                                                                       tokenized_test])
-        random.shuffle(self.train)
-        random.shuffle(self.dev)
-        random.shuffle(self.test)
-
-    def _save_tokenized_data(self, data, filename):
-        path = self.tokenized_data_path + filename + '.tokenized.json'
-        f = open(path,'w')
-        json.dump(data,f,indent=2)
-        f.close()
-
-    def _load_tokenized_data(self, filename):
-        '''
-        path = self.tokenized_data_path + filename + '.tokenized.json'
-        try:
-            f = open(path,'r')
-        except FileNotFoundError:
-            return None
-        data = json.load(f)
-        f.close()
-        return data
-        '''
-        return None
+            self.data_digest = self._data_digest(cache_files, cache_options)
+            cached = self._load_cached_data(self._data_cache_path(self.data_digest))
+        if cached is None:
+            train_json, dev_json, test_json = open(train_json_path), open(dev_json_path), open(test_json_path)
+            entity_json = open(entity_json_path)
+            train_data, dev_data, test_data = json.loads(train_json.read().lower()), \
+                                              json.loads(dev_json.read().lower()), json.loads(test_json.read().lower())
+            entity_data = json.loads(entity_json.read().lower())
+            self._get_entity_dict(entity_data)
+
+            tokenized_train = self._get_tokenized_data(train_data, construct_vocab, 'train')
+            tokenized_dev = self._get_tokenized_data(dev_data, construct_vocab, 'dev')
+            tokenized_test = self._get_tokenized_data(test_data, construct_vocab, 'test')
+
+            if construct_vocab:
+                self.vocab.construct(cfg.vocab_size)
+                self.vocab.save_vocab(cfg.vocab_path)
+
+            encoded_train, encoded_dev, encoded_test = map(self._get_encoded_data, [tokenized_train, tokenized_dev,
+                                                                                   tokenized_test])
+            self.data_digest = self._data_digest(cache_files, cache_options)
+            cached = self._save_cached_data(self._data_cache_path(self.data_digest),
+                                            {'train': encoded_train, 'dev': encoded_dev, 'test': encoded_test},
+                                            (self.db, self.entity_dict, self.abbr_dict))
+        splits, (self.db, self.entity_dict, self.abbr_dict) = cached
+        self.train, self.dev, self.test = splits['train'], splits['dev'], splits['test']
+        self.train.shuffle()
+        self.dev.shuffle()
+        self.test.shuffle()
 
     def _tokenize(self, sent):
         return ' '.join(word_tokenize(sent))
@@ -617,10 +1301,11 @@ class KvretReader(_ReaderBase):
             'schedule': ['event', 'date', 'time', 'party', 'agenda', 'room']
         }
         reqs = set()
-        for v, k in sorted(vk_map.items(), key=lambda x: -len(x[0])):
+
+        def replace_value(response, v, k):
+            if k not in requestable[intent]:
+                return response
             start_idx = response.find(v)
-            if start_idx == -1 or k not in requestable[intent]:
-                continue
             end_idx = start_idx + len(v)
             while end_idx < len(response) and response[end_idx] != ' ':
                 end_idx += 1
@@ -628,8 +1313,11 @@ class KvretReader(_ReaderBase):
             lm1, lm2 = v.replace('.', '').replace(' ', '').replace("'", ''), \
                        response[start_idx:end_idx].replace('.', '').replace(' ', '').replace("'", '')
             if lm1 == lm2 and lm1 not in prev_user_input and v not in prev_user_input:
-                response = clean_replace(response, response[start_idx:end_idx], k + '_SLOT')
                 reqs.add(k)
+                return clean_replace(response, response[start_idx:end_idx], k + '_SLOT')
+            return response
+
+        response = self._get_entity_matcher(vk_map).replace(response, replace_value)
         return response, reqs
 
     def _clean_constraint_dict(self, constraint_dict, intent, prefer='short'):
@@ -690,85 +1378,91 @@ class KvretReader(_ReaderBase):
         :param data_type:
         :return:
         """
-        tokenized_data = self._load_tokenized_data(data_type)
-        if tokenized_data is not None:
-            logging.info('directly loading %s' % data_type)
-            return tokenized_data
         tokenized_data = []
-        state_dump = {}
-        for dial_id, raw_dial in enumerate(raw_data):
-            tokenized_dial = []
-            prev_utter = ''
-            single_turn = {}
-            constraint_dict = {}
-            intent = raw_dial['scenario']['task']['intent']
-            if cfg.intent != 'all' and cfg.intent != intent:
-                if intent not in ['navigate', 'weather', 'schedule']:
-                    raise ValueError('what is %s intent bro?' % intent)
-                else:
-                    continue
-            prev_response = []
-            for turn_num, dial_turn in enumerate(raw_dial['dialogue']):
-                state_dump[(dial_id, turn_num)] = {}
-                if dial_turn['turn'] == 'driver':
-                    u = self._lemmatize(self._tokenize(dial_turn['data']['utterance']))
-                    u = re.sub('(\d+) ([ap]m)', lambda x: x.group(1) + x.group(2), u)
-                    single_turn['user'] = prev_response + u.split() + ['EOS_U']
-                    prev_utter += u
-                elif dial_turn['turn'] == 'assistant':
-                    s = dial_turn['data']['utterance']
-                    # find entities and replace them
-                    s = re.sub('(\d+) ([ap]m)', lambda x: x.group(1) + x.group(2), s)
-                    s, reqs = self._replace_entity(s, self.entity_dict, prev_utter, intent)
-                    single_turn['response'] = s.split() + ['EOS_M']
-                    # get constraints
-                    if not constraint_dict:
-                        constraint_dict = dial_turn['data']['slots']
-                    else:
-                        for k, v in dial_turn['data']['slots'].items():
-                            constraint_dict[k] = v
-                    constraint_dict = self._clean_constraint_dict(constraint_dict, intent)
-
-                    raw_constraints = constraint_dict.values()
-                    raw_constraints = [self._lemmatize(self._tokenize(_)) for _ in raw_constraints]
-
-                    # add separator
-                    constraints = []
-                    for item in raw_constraints:
-                        if constraints:
-                            constraints.append(';')
-                        constraints.extend(item.split())
-                    # get requests
-                    dataset_requested = set(
-                        filter(lambda x: dial_turn['data']['requested'][x], dial_turn['data']['requested'].keys()))
-                    requestable = {
-                        'weather': ['weather_attribute'],
-                        'navigate': ['poi', 'traffic_info', 'address', 'distance'],
-                        'schedule': ['date', 'time', 'party', 'agenda', 'room']
-                    }
-                    requests = sorted(list(dataset_requested.intersection(reqs)))
-
-                    single_turn['constraint'] = constraints + ['EOS_Z1']
-                    single_turn['requested'] = requests + ['EOS_Z2']
-                    single_turn['turn_num'] = len(tokenized_dial)
-                    single_turn['dial_id'] = dial_id
-                    single_turn['degree'] = self.db_degree(constraints, raw_dial['scenario']['kb']['items'])
-                    self.db[dial_id] = raw_dial['scenario']['kb']['items']
-                    if 'user' in single_turn:
-                        state_dump[(dial_id, len(tokenized_dial))]['constraint'] = constraint_dict
-                        state_dump[(dial_id, len(tokenized_dial))]['request'] = requests
-                        tokenized_dial.append(single_turn)
-                    prev_response = single_turn['response']
-                    single_turn = {}
+        self._get_entity_matcher(self.entity_dict)  # compiled before the workers of _map_dialogs fork
+        for dial_id, tokenized_dial in enumerate(self._map_dialogs(self._tokenize_dial, raw_data)):
+            if tokenized_dial is None:
+                continue
+            self.db[dial_id] = raw_data[dial_id]['scenario']['kb']['items']
+            # words are counted here in dialog order, so the vocab does not depend on the number of workers
             if add_to_vocab:
                 for single_turn in tokenized_dial:
                     for word_token in single_turn['constraint'] + single_turn['requested'] + \
                             single_turn['user'] + single_turn['response']:
                         self.vocab.add_item(word_token)
             tokenized_data.append(tokenized_dial)
-        self._save_tokenized_data(tokenized_data, data_type)
         return tokenized_data
 
+    def _tokenize_dial(self, dial_id, raw_dial):
+        """
+        tokenize a dialog, see _get_tokenized_data
+        :return: list of turns, None if the dialog is not of cfg.intent
+        """
+        state_dump = {}
+        tokenized_dial = []
+        prev_utter = ''
+        single_turn = {}
+        constraint_dict = {}
+        intent = raw_dial['scenario']['task']['intent']
+        if cfg.intent != 'all' and cfg.intent != intent:
+            if intent not in ['navigate', 'weather', 'schedule']:
+                raise ValueError('what is %s intent bro?' % intent)
+            else:
+                return None
+        prev_response = []
+        for turn_num, dial_turn in enumerate(raw_dial['dialogue']):
+            state_dump[(dial_id, turn_num)] = {}
+            if dial_turn['turn'] == 'driver':
+                u = self._lemmatize(self._tokenize(dial_turn['data']['utterance']))
+                u = re.sub('(\d+) ([ap]m)', lambda x: x.group(1) + x.group(2), u)
+                single_turn['user'] = prev_response + u.split() + ['EOS_U']
+                prev_utter += u
+            elif dial_turn['turn'] == 'assistant':
+                s = dial_turn['data']['utterance']
+                # find entities and replace them
+                s = re.sub('(\d+) ([ap]m)', lambda x: x.group(1) + x.group(2), s)
+                s, reqs = self._replace_entity(s, self.entity_dict, prev_utter, intent)
+                single_turn['response'] = s.split() + ['EOS_M']
+                # get constraints
+                if not constraint_dict:
+                    constraint_dict = dial_turn['data']['slots']
+                else:
+                    for k, v in dial_turn['data']['slots'].items():
+                        constraint_dict[k] = v
+                constraint_dict = self._clean_constraint_dict(constraint_dict, intent)
+
+                raw_constraints = constraint_dict.values()
+                raw_constraints = [self._lemmatize(self._tokenize(_)) for _ in raw_constraints]
+
+                # add separator
+                constraints = []
+                for item in raw_constraints:
+                    if constraints:
+                        constraints.append(';')
+                    constraints.extend(item.split())
+                # get requests
+                dataset_requested = set(
+                    filter(lambda x: dial_turn['data']['requested'][x], dial_turn['data']['requested'].keys()))
+                requestable = {
+                    'weather': ['weather_attribute'],
+                    'navigate': ['poi', 'traffic_info', 'address', 'distance'],
+                    'schedule': ['date', 'time', 'party', 'agenda', 'room']
+                }
+                requests = sorted(list(dataset_requested.intersection(reqs)))
+
+                single_turn['constraint'] = constraints + ['EOS_Z1']
+                single_turn['requested'] = requests + ['EOS_Z2']
+                single_turn['turn_num'] = len(tokenized_dial)
+                single_turn['dial_id'] = dial_id
+                single_turn['degree'] = self.db_degree(constraints, raw_dial['scenario']['kb']['items'])
+                if 'user' in single_turn:
+                    state_dump[(dial_id, len(tokenized_dial))]['constraint'] = constraint_dict
+                    state_dump[(dial_id, len(tokenized_dial))]['request'] = requests
+                    tokenized_dial.append(single_turn)
+                prev_response = single_turn['response']
+                single_turn = {}
+        return tokenized_dial
+
     def _get_encoded_data(self, tokenized_data):
         encoded_data = []
         for dial in tokenized_data:
@@ -777,6 +1471,7 @@ class KvretReader(_ReaderBase):
                 turn['constraint'] = self.vocab.sentence_encode(turn['constraint'])
                 turn['requested'] = self.vocab.sentence_encode(turn['requested'])
                 turn['bspan'] = turn['constraint'] + turn['requested']
+                turn['bspan_copy'] = get_selective_copy_target(self.vocab, turn['bspan'])
                 turn['user'] = self.vocab.sentence_encode(turn['user'])
                 turn['response'] = self.vocab.sentence_encode(turn['response'])
                 turn['u_len'] = len(turn['user'])
@@ -807,10 +1502,31 @@ class KvretReader(_ReaderBase):
                             self.abbr_dict[entity.split()[0]] = entity
         self.entity_dict = entity_dict
 
+    def _constraint_phrases(self, constraints):
+        constraints = ' '.join(constraints).split(' ; ')
+        return [_.strip() for _ in constraints]
+
+    def _get_kb_index(self, items):
+        """
+        the compiled index of a KB item list, built the first time the list is seen
+        """
+        kb = self.kb_index.get(id(items))
+        if kb is None or kb.items is not items:
+            kb = KvretKBIndex(items)
+            self.kb_index[id(items)] = kb
+        return kb
+
     def db_degree(self, constraints, items):
+        if items is None:
+            return 0
+        return self._get_kb_index(items).count(self._constraint_phrases(constraints))
+
+    def _db_degree_scan(self, constraints, items):
+        """
+        db_degree by matching every item with db_match, kept as the reference of benchmark_db_degree
+        """
         cnt = 0
-        constraints = ' '.join(constraints).split(' ; ')
-        constraints = [_.strip() for _ in constraints]
+        constraints = self._constraint_phrases(constraints)
         if items is not None:
             for item in items:
                 if self.db_match(constraints, item):
@@ -843,21 +1559,94 @@ class KvretReader(_ReaderBase):
     def db_degree_handler(self, z_samples, idx=None, *args, **kwargs):
         control_vec = []
         for i,cons_idx_list in enumerate(z_samples):
-            constraints = set()
-            for cons in cons_idx_list:
-                if type(cons) is not str:
-                    cons = self.vocab.decode(cons)
-                if cons == 'EOS_Z1':
-                    break
-                constraints.add(cons)
-            items = self.db[idx[i]]
-            degree = self.db_degree(constraints, items)
-            control_vec.append(self._degree_vec_mapping(degree))
+            control_vec.append(self._degree_vec(idx[i], self._constraint_key(cons_idx_list)))
         return np.array(control_vec)
 
+    def _get_degree_vec(self, db_key, cons_key):
+        degree = self.db_degree(self._decode_constraint_key(cons_key), self.db[db_key])
+        return tuple(self._degree_vec_mapping(degree))
+
+    def benchmark_db_degree(self):
+        """
+        compute the degree vectors of every test turn with db_degree and with the item scan it replaces,
+        log the time of both and the number of turns where they differ
+        :return: number of mismatching turns
+        """
+        turns = [(turn['dial_id'], self._decode_constraint_key(self._constraint_key(turn['constraint'])))
+                 for dial in self.test for turn in dial]
+        self.kb_index = {}
+        results, times = [], []
+        for degree_fn in [self._db_degree_scan, self.db_degree]:
+            start = time.time()
+            results.append([self._degree_vec_mapping(degree_fn(constraints, self.db[dial_id]))
+                            for dial_id, constraints in turns])
+            times.append(time.time() - start)
+        mismatch = sum(old != new for old, new in zip(*results))
+        logging.info('db degree of %d test turns: scan %.4fs, index %.4fs (incl. build), %d mismatches' %
+                     (len(turns), times[0], times[1], mismatch))
+        return mismatch
+
+
+def _is_flat_int_batch(sequences):
+    """
+    whether every sequence is a 1-D list, tuple or array of scalars, the case of pad_sequences' fast path
+    """
+    if not isinstance(sequences, (list, tuple)) or not sequences:
+        return False
+    for x in sequences:
+        if isinstance(x, np.ndarray):
+            if x.ndim != 1:
+                return False
+        elif not isinstance(x, (list, tuple)):
+            return False
+    first = next((x for x in sequences if len(x)), None)
+    return first is None or np.ndim(first[0]) == 0
+
 
 def pad_sequences(sequences, maxlen=None, dtype='int32',
-                  padding='pre', truncating='pre', value=0.):
+                  padding='pre', truncating='pre', value=0., time_major=False):
+    """
+    pad a batch of sequences into one matrix
+    :param time_major: return [T,B] instead of [B,T]
+    :return: [B,T] or [T,B] numpy array
+    """
+    if not _is_flat_int_batch(sequences):
+        x = _pad_sequences_general(sequences, maxlen, dtype, padding, truncating, value)
+        return np.ascontiguousarray(x.transpose((1, 0))) if time_major else x
+    if truncating not in ['pre', 'post']:
+        raise ValueError('Truncating type "%s" not understood' % truncating)
+    if padding not in ['pre', 'post']:
+        raise ValueError('Padding type "%s" not understood' % padding)
+
+    num_samples = len(sequences)
+    lengths = np.fromiter(map(len, sequences), dtype=np.int64, count=num_samples)
+    seq_maxlen = int(lengths.max())
+    if maxlen is not None and cfg.truncated:
+        maxlen = min(seq_maxlen, maxlen)
+    else:
+        maxlen = seq_maxlen
+    lens = np.minimum(lengths, maxlen)
+    if seq_maxlen > maxlen:
+        sequences = [s[-maxlen:] if truncating == 'pre' else s[:maxlen] for s in sequences]
+    total = int(lens.sum())
+    flat = np.fromiter(itertools.chain.from_iterable(sequences), dtype=dtype, count=total)
+
+    # scatter every token to (row, column) of the padded matrix
+    rows = np.repeat(np.arange(num_samples), lens)
+    cols = np.arange(total) - np.repeat(np.cumsum(lens) - lens, lens)
+    if padding == 'pre':
+        cols += np.repeat(maxlen - lens, lens)
+    shape = (maxlen, num_samples) if time_major else (num_samples, maxlen)
+    x = np.full(shape, value, dtype=dtype)
+    if time_major:
+        x[cols, rows] = flat
+    else:
+        x[rows, cols] = flat
+    return x
+
+
+def _pad_sequences_general(sequences, maxlen=None, dtype='int32',
+                           padding='pre', truncating='pre', value=0.):
     if not hasattr(sequences, '__len__'):
         raise ValueError('`sequences` must be iterable.')
     lengths = []
@@ -10,7 +10,7 @@ from config import global_config as cfg
 import copy, random, time, logging
 
 from torch.distributions import Categorical
-from reader import pad_sequences
+from reader import pad_sequences, get_selective_copy_target
 
 
 def cuda_(var):
@@ -47,6 +47,168 @@ def get_sparse_input_aug(x_input_np):
     return result
 
 
+def get_index_input_aug(x_input_np):
+    """
+    index form of get_sparse_input_aug. Instead of a dense [B,T,V+T] one-hot tensor, keep for every source
+    position the column of the extended vocab it is copied into, and a 0/1 weight masking out ignored tokens.
+    :param x_input_np: [T,B]
+    :return: (LongTensor [B,T], FloatTensor [B,T])
+    """
+    unk = 2
+    x_input_np = x_input_np.transpose((1, 0))
+    index = np.where(x_input_np == unk, cfg.vocab_size + np.arange(x_input_np.shape[1]), x_input_np)
+    weight = (x_input_np != 0).astype(np.float32)
+    index = cuda_(Variable(torch.from_numpy(index).long()))
+    weight = cuda_(Variable(torch.from_numpy(weight).float()))
+    return index, weight
+
+
+def get_copy_input_aug(x_input_np):
+    """
+    build the copy source of a turn once, in the form selected by cfg.copy_mode
+    """
+    if cfg.copy_mode == 'index':
+        return get_index_input_aug(x_input_np)
+    return cuda_(Variable(get_sparse_input_aug(x_input_np), requires_grad=False))
+
+
+def copy_score_aug(copy_score, copy_input, pad_mask=None):
+    """
+    aggregate copy scores over source positions into the extended vocab, in log space
+    :param copy_score: [B,T]
+    :param copy_input: dense [B,T,V+T] tensor or (index, weight) pair, see get_copy_input_aug
+    :param pad_mask: optional [B,T] mask of the positions padded beyond the own turn of a row, see length_mask.
+        They copy nothing and their positional columns get a score of -inf.
+    :return: [B,V+T]
+    """
+    if pad_mask is not None:
+        copy_score = copy_score.masked_fill(pad_mask, -float('inf'))
+    copy_score_max = torch.max(copy_score, dim=1, keepdim=True)[0]
+    copy_score = torch.exp(copy_score - copy_score_max)  # [B,T]
+    if isinstance(copy_input, tuple):
+        index, weight = copy_input
+        # the dense form has 1e-10 in every non-hit cell, so every column also collects 1e-10 of the total mass
+        aug = copy_score.new_zeros((copy_score.size(0), cfg.vocab_size + index.size(1)))
+        aug = aug.scatter_add(1, index, copy_score * weight) + 1e-10 * copy_score.sum(1, keepdim=True)
+    else:
+        aug = torch.bmm(copy_score.unsqueeze(1), copy_input).squeeze(1)
+    aug = torch.log(aug) + copy_score_max
+    if pad_mask is not None:
+        aug = aug.masked_fill(torch.cat([pad_mask.new_zeros((pad_mask.size(0), cfg.vocab_size)), pad_mask], 1),
+                              -float('inf'))
+    return aug
+
+
+def select_copy_input(copy_input, index):
+    """
+    select batch rows of a copy source built by get_copy_input_aug or get_selective_copy_input
+    """
+    if isinstance(copy_input, tuple):
+        return tuple(_.index_select(0, index) for _ in copy_input)
+    return copy_input.index_select(0, index)
+
+
+def softmax_proba(scores, log_proba=False):
+    """
+    normalise decoder scores into probabilities, or log-probabilities when log_proba is set
+    """
+    if log_proba:
+        return F.log_softmax(scores, dim=1)
+    return F.softmax(scores, dim=1)
+
+
+def add_proba(probas, log_proba=False):
+    """
+    sum the probabilities of a token over several sources, with logsumexp when they are log-probabilities
+    :param probas: list of [B,V] tensors
+    """
+    if log_proba:
+        return torch.logsumexp(torch.stack(probas, dim=0), dim=0)
+    return sum(probas[1:], probas[0])
+
+
+def get_attn_keys(attn, encoder_outputs):
+    """
+    key projections of an attention over encoder_outputs, or None when cfg.attn_key_cache is off
+    """
+    if not cfg.attn_key_cache:
+        return None
+    return attn.project_keys(encoder_outputs)
+
+
+def select_attn_keys(keys, index):
+    """
+    select batch rows of attention keys built by get_attn_keys, a single tensor or a tuple of them
+    """
+    if keys is None:
+        return None
+    if isinstance(keys, tuple):
+        return tuple(select_attn_keys(_, index) for _ in keys)
+    return keys.index_select(0, index)
+
+
+def capture_stop_hidden(last_hidden, z_tm1, stop_id, captured=None, seen=None, active=None):
+    """
+    remember the hidden state of the rows fed stop_id at this step, a later hit overwrites an earlier one
+    :param last_hidden: [L,B,H]
+    :param z_tm1: [1,B]
+    :param active: optional mask [1,B,1] of the rows still within their own length, see step_active
+    :return: captured hidden [L,B,H] and mask of rows seen so far [1,B,1]
+    """
+    hit = (z_tm1 == stop_id).view(1, -1, 1)
+    if active is not None:
+        hit = hit & active
+    if captured is None:
+        return last_hidden, hit
+    return torch.where(hit, last_hidden, captured), seen | hit
+
+
+def length_mask(lengths, max_len):
+    """
+    mask of the positions of a padded sequence beyond the length of its row. In turn-parallel training, rows of
+    several turns share a batch padded to the longest of them, and the positions a row would not have in its own
+    turn are masked out of attention, copy and decoding.
+    :param lengths: numpy array [B] of lengths, None if no row is padded beyond its own length
+    :return: BoolTensor [B,T], None if lengths is None
+    """
+    if lengths is None:
+        return None
+    mask = np.arange(max_len)[None, :] >= np.asarray(lengths)[:, None]
+    return cuda_(torch.from_numpy(mask))
+
+
+def cat_masks(masks, sizes):
+    """
+    concatenate the masks of sequences concatenated in time, where a None mask masks nothing
+    :param sizes: length of every sequence
+    :return: BoolTensor [B,sum(sizes)], None if all masks are None
+    """
+    if all(_ is None for _ in masks):
+        return None
+    batch_size = next(_ for _ in masks if _ is not None).size(0)
+    masks = [_ if _ is not None else cuda_(torch.zeros(batch_size, size, dtype=torch.bool))
+             for _, size in zip(masks, sizes)]
+    return torch.cat(masks, dim=1)
+
+
+def step_active(mask, t):
+    """
+    rows of a length_mask still within their own length at decoding step t, as [1,B,1], None if mask is None
+    """
+    if mask is None:
+        return None
+    return (~mask[:, t]).view(1, -1, 1)
+
+
+def keep_inactive(new_hidden, last_hidden, active):
+    """
+    the rows past their own length keep their hidden state, so the decoder hands over what their own turn would
+    """
+    if active is None:
+        return new_hidden
+    return torch.where(active, new_hidden, last_hidden)
+
+
 def init_gru(gru):
     gru.reset_parameters()
     for _, hh, _, _ in gru.all_weights:
@@ -63,10 +225,13 @@ class Attn(nn.Module):
         stdv = 1. / math.sqrt(self.v.size(0))
         self.v.data.normal_(mean=0, std=stdv)
 
-    def forward(self, hidden, encoder_outputs, mask=False, inp_seqs=None, stop_tok=None, normalize=True):
+    def forward(self, hidden, encoder_outputs, mask=False, inp_seqs=None, stop_tok=None, normalize=True, keys=None,
+                pad_mask=None):
         #print("encoder_outputs", encoder_outputs.shape )
         encoder_outputs = encoder_outputs.transpose(0, 1)  # [B,T,H]
-        attn_energies = self.score(hidden, encoder_outputs)
+        attn_energies = self.score(hidden, encoder_outputs, keys)
+        if pad_mask is not None:
+            attn_energies = attn_energies.masked_fill(pad_mask.unsqueeze(1), -float('inf'))  # see length_mask
         if True or not mask:
             normalized_energy = F.softmax(attn_energies, dim=2)  # [B,1,T]
         else:
@@ -87,10 +252,23 @@ class Attn(nn.Module):
         context = torch.bmm(normalized_energy, encoder_outputs)  # [B,1,H]
         return context.transpose(0, 1)  # [1,B,H]
 
-    def score(self, hidden, encoder_outputs):
-        max_len = encoder_outputs.size(1)
-        H = hidden.repeat(max_len, 1, 1).transpose(0, 1)
-        energy = F.tanh(self.attn(torch.cat([H, encoder_outputs], 2)))  # [B,T,2H]->[B,T,H]
+    def project_keys(self, encoder_outputs):
+        """
+        encoder half of the attention projection. It does not change between decoding steps, so it can be
+        computed once per turn and passed to forward as `keys`.
+        :param encoder_outputs: [T,B,H]
+        :return: [B,T,H]
+        """
+        return F.linear(encoder_outputs.transpose(0, 1), self.attn.weight[:, self.hidden_size:], self.attn.bias)
+
+    def score(self, hidden, encoder_outputs, keys=None):
+        if keys is not None:
+            query = F.linear(hidden, self.attn.weight[:, :self.hidden_size]).transpose(0, 1)  # [B,1,H]
+            energy = F.tanh(keys + query)  # [B,T,H]
+        else:
+            max_len = encoder_outputs.size(1)
+            H = hidden.repeat(max_len, 1, 1).transpose(0, 1)
+            energy = F.tanh(self.attn(torch.cat([H, encoder_outputs], 2)))  # [B,T,2H]->[B,T,H]
         energy = energy.transpose(2, 1)  # [B,H,T]
         v = self.v.repeat(encoder_outputs.size(0), 1).unsqueeze(1)  # [B,1,H]
         energy = torch.bmm(v, energy)  # [B,1,T]
@@ -128,6 +306,38 @@ class SimpleDynamicEncoder(nn.Module):
         hidden = hidden.transpose(0, 1)[unsort_idx].transpose(0, 1).contiguous()
         return outputs, hidden, embedded
 
+    def forward_pair(self, first_seqs, first_lens, second_seqs, second_lens):
+        """
+        encode two batches with a single GRU call, same results as calling forward on each of them
+        :param first_seqs: [T1,B]
+        :param second_seqs: [T2,B]
+        :return: (outputs, hidden, embedded) of the first batch and of the second batch
+        """
+        batch_size = first_seqs.size(1)
+        max_len = max(first_seqs.size(0), second_seqs.size(0))
+        input_seqs = [F.pad(_, (0, 0, 0, max_len - _.size(0))) for _ in (first_seqs, second_seqs)]
+        input_seqs = torch.cat(input_seqs, dim=1)  # [T,2B]
+        input_lens = np.concatenate([first_lens, second_lens])
+        embedded = self.embedding(input_seqs).transpose(0, 1)  # [2B,T,E]
+        sort_idx = np.argsort(-input_lens)
+        unsort_idx = cuda_(torch.LongTensor(np.argsort(sort_idx)))
+        packed = torch.nn.utils.rnn.pack_padded_sequence(embedded[cuda_(torch.LongTensor(sort_idx))].transpose(0, 1),
+                                                         input_lens[sort_idx])
+        outputs, hidden = self.gru(packed)
+        outputs, _ = torch.nn.utils.rnn.pad_packed_sequence(outputs)
+        outputs = outputs[:, :, :self.hidden_size] + outputs[:, :, self.hidden_size:]
+        outputs = outputs.transpose(0, 1)[unsort_idx].transpose(0, 1)
+        hidden = hidden.transpose(0, 1)[unsort_idx].transpose(0, 1)
+        results = []
+        for rows, seqs, lens in [(slice(0, batch_size), first_seqs, first_lens),
+                                 (slice(batch_size, 2 * batch_size), second_seqs, second_lens)]:
+            # forward pads the outputs to the longest sequence of its own batch and returns the
+            # embeddings in its own length order
+            own_sort_idx = cuda_(torch.LongTensor(np.argsort(-lens)))
+            results.append((outputs[:int(lens.max()), rows].contiguous(), hidden[:, rows].contiguous(),
+                            embedded[rows][:, :seqs.size(0)][own_sort_idx].transpose(0, 1)))
+        return results[0], results[1]
+
 
 class BSpanDecoder_noCopyNet(nn.Module):
     def __init__(self, bspanEmb, embed_size, hidden_size, vocab_size, dropout_rate, vocab):
@@ -157,14 +367,21 @@ class BSpanDecoder_noCopyNet(nn.Module):
         position_enc[1:, 1::2] = np.cos(position_enc[1:, 1::2])  # dim 2i+1
         return torch.from_numpy(position_enc).type(torch.FloatTensor)
 
+    def project_keys(self, u_enc_out, pv_z_enc_out):
+        """
+        attention keys of a turn, see get_attn_keys
+        """
+        return get_attn_keys(self.attn_u, torch.cat([pv_z_enc_out, u_enc_out], dim=0))
+
     def forward(self, u_enc_out, z_tm1, last_hidden, u_input_np, pv_z_enc_out, prev_z_input_np, u_emb, pv_z_emb,
-                position, stop_tok=None):
+                position, stop_tok=None, attn_keys=None, log_proba=False, u_pad_mask=None, pv_z_pad_mask=None):
 
         if stop_tok is None:
             stop_tok = [self.vocab.encode('EOS_M')]
         context = self.attn_u(last_hidden, torch.cat([pv_z_enc_out, u_enc_out], dim=0), mask=True,
                         inp_seqs=np.concatenate([prev_z_input_np, u_input_np], 0),
-                        stop_tok=stop_tok)
+                        stop_tok=stop_tok, keys=attn_keys,
+                        pad_mask=cat_masks([pv_z_pad_mask, u_pad_mask], [pv_z_enc_out.size(0), u_enc_out.size(0)]))
 
         embed_z = self.emb(z_tm1)
 
@@ -177,7 +394,7 @@ class BSpanDecoder_noCopyNet(nn.Module):
         gru_out, last_hidden = self.gru(gru_in, last_hidden)
         gen_score = self.proj(torch.cat([gru_out, context], 2)).squeeze(0)
         
-        scores = F.softmax(gen_score, dim=1)
+        scores = softmax_proba(gen_score, log_proba)
        
         gen_score = scores[:, :cfg.vocab_size]
         
@@ -215,18 +432,30 @@ class BSpanDecoder(nn.Module):
         position_enc[1:, 1::2] = np.cos(position_enc[1:, 1::2])  # dim 2i+1
         return torch.from_numpy(position_enc).type(torch.FloatTensor)
 
+    def project_keys(self, u_enc_out, pv_z_enc_out):
+        """
+        attention keys of a turn, see get_attn_keys
+        """
+        if pv_z_enc_out is not None:
+            u_enc_out = torch.cat([pv_z_enc_out, u_enc_out], dim=0)
+        return get_attn_keys(self.attn_u, u_enc_out)
+
     def forward(self, u_enc_out, z_tm1, last_hidden, u_input_np, pv_z_enc_out, prev_z_input_np, u_emb, pv_z_emb,
-                position):
+                position, sparse_u_input=None, sparse_pv_z_input=None, attn_keys=None, log_proba=False,
+                u_pad_mask=None, pv_z_pad_mask=None):
 
-        sparse_u_input = Variable(get_sparse_input_aug(u_input_np), requires_grad=False)
+        if sparse_u_input is None:
+            sparse_u_input = get_copy_input_aug(u_input_np)
 
         if pv_z_enc_out is not None:
             context = self.attn_u(last_hidden, torch.cat([pv_z_enc_out, u_enc_out], dim=0), mask=True,
                                   inp_seqs=np.concatenate([prev_z_input_np, u_input_np], 0),
-                                  stop_tok=[self.vocab.encode('EOS_M')])
+                                  stop_tok=[self.vocab.encode('EOS_M')], keys=attn_keys,
+                                  pad_mask=cat_masks([pv_z_pad_mask, u_pad_mask],
+                                                     [pv_z_enc_out.size(0), u_enc_out.size(0)]))
         else:
             context = self.attn_u(last_hidden, u_enc_out, mask=True, inp_seqs=u_input_np,
-                                  stop_tok=[self.vocab.encode('EOS_M')])
+                                  stop_tok=[self.vocab.encode('EOS_M')], keys=attn_keys, pad_mask=u_pad_mask)
         embed_z = self.emb(z_tm1)
 
         if cfg.use_positional_embedding:  # defaulty not used
@@ -240,34 +469,26 @@ class BSpanDecoder(nn.Module):
         gen_score = self.proj(torch.cat([gru_out, context], 2)).squeeze(0)
         u_copy_score = F.tanh(self.proj_copy1(u_enc_out.transpose(0, 1)))  # [B,T,H]
         u_copy_score = torch.matmul(u_copy_score, gru_out.squeeze(0).unsqueeze(2)).squeeze(2)
-        u_copy_score = u_copy_score.cpu()
-        u_copy_score_max = torch.max(u_copy_score, dim=1, keepdim=True)[0]
-        u_copy_score = torch.exp(u_copy_score - u_copy_score_max)  # [B,T]
-        u_copy_score = torch.log(torch.bmm(u_copy_score.unsqueeze(1), sparse_u_input)).squeeze(
-            1) + u_copy_score_max  # [B,V]
-        u_copy_score = cuda_(u_copy_score)
+        u_copy_score = copy_score_aug(u_copy_score, sparse_u_input, u_pad_mask)  # [B,V+T]
         if pv_z_enc_out is None:
-            scores = F.softmax(torch.cat([gen_score, u_copy_score], dim=1), dim=1)
+            scores = softmax_proba(torch.cat([gen_score, u_copy_score], dim=1), log_proba)
             gen_score, u_copy_score = scores[:, :cfg.vocab_size], \
                                       scores[:, cfg.vocab_size:]
-            proba = gen_score + u_copy_score[:, :cfg.vocab_size]  # [B,V]
+            proba = add_proba([gen_score, u_copy_score[:, :cfg.vocab_size]], log_proba)  # [B,V]
             proba = torch.cat([proba, u_copy_score[:, cfg.vocab_size:]], 1)
         else:
-            sparse_pv_z_input = Variable(get_sparse_input_aug(prev_z_input_np), requires_grad=False)
+            if sparse_pv_z_input is None:
+                sparse_pv_z_input = get_copy_input_aug(prev_z_input_np)
             pv_z_copy_score = F.tanh(self.proj_copy2(pv_z_enc_out.transpose(0, 1)))  # [B,T,H]
             pv_z_copy_score = torch.matmul(pv_z_copy_score, gru_out.squeeze(0).unsqueeze(2)).squeeze(2)
-            pv_z_copy_score = pv_z_copy_score.cpu()
-            pv_z_copy_score_max = torch.max(pv_z_copy_score, dim=1, keepdim=True)[0]
-            pv_z_copy_score = torch.exp(pv_z_copy_score - pv_z_copy_score_max)  # [B,T]
-            pv_z_copy_score = torch.log(torch.bmm(pv_z_copy_score.unsqueeze(1), sparse_pv_z_input)).squeeze(
-                1) + pv_z_copy_score_max  # [B,V]
-            pv_z_copy_score = cuda_(pv_z_copy_score)
-            scores = F.softmax(torch.cat([gen_score, u_copy_score, pv_z_copy_score], dim=1), dim=1)
+            pv_z_copy_score = copy_score_aug(pv_z_copy_score, sparse_pv_z_input, pv_z_pad_mask)  # [B,V+T]
+            scores = softmax_proba(torch.cat([gen_score, u_copy_score, pv_z_copy_score], dim=1), log_proba)
             gen_score, u_copy_score, pv_z_copy_score = scores[:, :cfg.vocab_size], \
                                                        scores[:,
                                                        cfg.vocab_size:2 * cfg.vocab_size + u_input_np.shape[0]], \
                                                        scores[:, 2 * cfg.vocab_size + u_input_np.shape[0]:]
-            proba = gen_score + u_copy_score[:, :cfg.vocab_size] + pv_z_copy_score[:, :cfg.vocab_size]  # [B,V]
+            proba = add_proba([gen_score, u_copy_score[:, :cfg.vocab_size], pv_z_copy_score[:, :cfg.vocab_size]],
+                              log_proba)  # [B,V]
             proba = torch.cat([proba, pv_z_copy_score[:, cfg.vocab_size:], u_copy_score[:, cfg.vocab_size:]], 1)
         return gru_out, last_hidden, proba
 
@@ -309,31 +530,67 @@ class ResponseDecoder(nn.Module):
         result = torch.from_numpy(result_np).float()
         return result
 
-    def forward(self, z_enc_out, u_enc_out, u_input_np, m_t_input, degree_input, last_hidden, z_input_np):
-        sparse_z_input = Variable(self.get_sparse_selective_input(z_input_np), requires_grad=False)
+    def get_selective_index_input(self, z_copy_np):
+        """
+        index form of get_sparse_selective_input
+        :param z_copy_np: [T,B] copy targets of the bspan tokens, see reader.get_selective_copy_target
+        :return: (LongTensor [B,T], FloatTensor [B,T])
+        """
+        z_copy_np = z_copy_np.transpose((1, 0))
+        # the token at t is copied into row t + 1, row 0 copies nothing
+        target = np.zeros_like(z_copy_np)
+        target[:, 1:] = z_copy_np[:, :-1]
+        positional = target == -1
+        index = np.where(positional, cfg.vocab_size + np.arange(target.shape[1]) - 1, target)
+        weight = np.where(positional, 5.0, 1.0)
+        weight[:, 0] = 0.
+        index = cuda_(Variable(torch.from_numpy(index).long()))
+        weight = cuda_(Variable(torch.from_numpy(weight).float()))
+        return index, weight
+
+    def get_selective_copy_input(self, z_input_np, z_copy_np=None):
+        """
+        build the selective copy source of a turn once, in the form selected by cfg.copy_mode
+        :param z_input_np: [T,B]
+        :param z_copy_np: optional precomputed copy targets of z_input_np
+        """
+        if cfg.copy_mode != 'index':
+            return cuda_(Variable(self.get_sparse_selective_input(z_input_np), requires_grad=False))
+        if z_copy_np is None:
+            z_copy_np = np.array(get_selective_copy_target(self.vocab, z_input_np.reshape(-1)))
+            z_copy_np = z_copy_np.reshape(z_input_np.shape)
+        return self.get_selective_index_input(z_copy_np)
+
+    def project_keys(self, z_enc_out, u_enc_out):
+        """
+        attention keys of a turn for attn_z and attn_u, see get_attn_keys
+        """
+        if not cfg.attn_key_cache:
+            return None
+        return get_attn_keys(self.attn_z, z_enc_out), get_attn_keys(self.attn_u, u_enc_out)
+
+    def forward(self, z_enc_out, u_enc_out, u_input_np, m_t_input, degree_input, last_hidden, z_input_np,
+                sparse_z_input=None, attn_keys=None, log_proba=False, z_pad_mask=None, u_pad_mask=None):
+        if sparse_z_input is None:
+            sparse_z_input = self.get_selective_copy_input(z_input_np)
+        z_keys, u_keys = attn_keys if attn_keys is not None else (None, None)
 
         m_embed = self.emb(m_t_input)
         z_context = self.attn_z(last_hidden, z_enc_out, mask=True, stop_tok=[self.vocab.encode('EOS_Z2')],
-                                inp_seqs=z_input_np)
+                                inp_seqs=z_input_np, keys=z_keys, pad_mask=z_pad_mask)
         u_context = self.attn_u(last_hidden, u_enc_out, mask=True, stop_tok=[self.vocab.encode('EOS_M')],
-                                inp_seqs=u_input_np)
+                                inp_seqs=u_input_np, keys=u_keys, pad_mask=u_pad_mask)
         gru_in = torch.cat([m_embed, u_context, z_context, degree_input.unsqueeze(0)], dim=2)
         gru_out, last_hidden = self.gru(gru_in, last_hidden)
         gen_score = self.proj(torch.cat([z_context, u_context, gru_out], 2)).squeeze(0)
         z_copy_score = F.tanh(self.proj_copy2(z_enc_out.transpose(0, 1)))
         z_copy_score = torch.matmul(z_copy_score, gru_out.squeeze(0).unsqueeze(2)).squeeze(2)
-        z_copy_score = z_copy_score.cpu()
-        z_copy_score_max = torch.max(z_copy_score, dim=1, keepdim=True)[0]
-        z_copy_score = torch.exp(z_copy_score - z_copy_score_max)  # [B,T]
-
-        z_copy_score = torch.log(torch.bmm(z_copy_score.unsqueeze(1), sparse_z_input)).squeeze(
-            1) + z_copy_score_max  # [B,V]
-        z_copy_score = cuda_(z_copy_score)
+        z_copy_score = copy_score_aug(z_copy_score, sparse_z_input, z_pad_mask)  # [B,V+T]
 
-        scores = F.softmax(torch.cat([gen_score, z_copy_score], dim=1), dim=1)
+        scores = softmax_proba(torch.cat([gen_score, z_copy_score], dim=1), log_proba)
         gen_score, z_copy_score = scores[:, :cfg.vocab_size], \
                                   scores[:, cfg.vocab_size:]
-        proba = gen_score + z_copy_score[:, :cfg.vocab_size]  # [B,V]
+        proba = add_proba([gen_score, z_copy_score[:, :cfg.vocab_size]], log_proba)  # [B,V]
         proba = torch.cat([proba, z_copy_score[:, cfg.vocab_size:]], 1)
         return proba, last_hidden, gru_out
 
@@ -422,7 +679,11 @@ class TSD(nn.Module):
                 self.forward_turn(u_input, u_len, m_input=m_input, m_len=m_len, z_input=z_input, z1_input=z1_input, z2_input=z2_input, z3_input=z3_input,  mode='train',
                                   turn_states=turn_states, degree_input=degree_input, u_input_np=u_input_np,
                                   m_input_np=m_input_np, **kwargs)
-            loss, pr_loss,pr1_loss,pr2_loss,pr3_loss, m_loss = self.supervised_loss(torch.log(pz_proba), torch.log(pz1_proba), torch.log(pz2_proba), torch.log(pz3_proba), torch.log(pm_dec_proba),
+            if not cfg.log_proba:
+                pz_proba, pz1_proba, pz2_proba, pz3_proba, pm_dec_proba = torch.log(pz_proba), torch.log(pz1_proba), \
+                                                                          torch.log(pz2_proba), torch.log(pz3_proba), \
+                                                                          torch.log(pm_dec_proba)
+            loss, pr_loss,pr1_loss,pr2_loss,pr3_loss, m_loss = self.supervised_loss(pz_proba, pz1_proba, pz2_proba, pz3_proba, pm_dec_proba,
                                                          z_input, z1_input, z2_input, z3_input,  m_input)
             #print(loss)
             return loss, pr_loss,pr1_loss,pr2_loss,pr3_loss, m_loss, turn_states
@@ -446,6 +707,32 @@ class TSD(nn.Module):
 
   
 
+    def turn_parallel_loss(self, turn_slices, u_input, u_input_np, m_input, m_input_np, z_input, z1_input, z2_input,
+                           z3_input, u_len, m_len, turn_states, degree_input, mode, **kwargs):
+        """
+        supervised losses of several turns decoded as one batch. Rows padded beyond the lengths of their own turn
+        give kwargs['pad_lengths'], the own padded length of every row for 'u', 'prev_z', 'z' and 'z3', and
+        those positions are masked, see length_mask, so every turn gets the loss of decoding it alone.
+        :param turn_slices: batch rows belonging to each turn
+        :return: list of (loss, pr_loss, pr1_loss, pr2_loss, pr3_loss, m_loss), one per turn
+        """
+        pz_proba, pz1_proba, pz2_proba, pz3_proba, pm_dec_proba, turn_states = \
+            self.forward_turn(u_input, u_len, m_input=m_input, m_len=m_len, z_input=z_input, z1_input=z1_input,
+                              z2_input=z2_input, z3_input=z3_input, mode='train', turn_states=turn_states,
+                              degree_input=degree_input, u_input_np=u_input_np, m_input_np=m_input_np, **kwargs)
+        if not cfg.log_proba:
+            pz_proba, pz1_proba, pz2_proba, pz3_proba, pm_dec_proba = torch.log(pz_proba), torch.log(pz1_proba), \
+                                                                      torch.log(pz2_proba), torch.log(pz3_proba), \
+                                                                      torch.log(pm_dec_proba)
+        turn_losses = []
+        for s in turn_slices:
+            turn_losses.append(self.supervised_loss(pz_proba[:, s], pz1_proba[:, s], pz2_proba[:, s],
+                                                    pz3_proba[:, s], pm_dec_proba[:, s],
+                                                    z_input[:, s].contiguous(), z1_input[:, s].contiguous(),
+                                                    z2_input[:, s].contiguous(), z3_input[:, s].contiguous(),
+                                                    m_input[:, s].contiguous()))
+        return turn_losses
+
     def forward_turn(self, u_input, u_len, turn_states, mode, degree_input, u_input_np, m_input_np=None,
                      m_input=None, m_len=None, z_input=None, z1_input=None, z2_input=None, z3_input=None, **kwargs):
       
@@ -481,15 +768,20 @@ class TSD(nn.Module):
 
         
         if prev_z_input is not None: 
-            pv_z_enc_out, _, pv_z_emb = self.u_encoder(prev_z_input, prev_z_len) 
-
-        u_enc_out, u_enc_hidden, u_emb = self.u_encoder(u_input, u_len) 
+            (pv_z_enc_out, _, pv_z_emb), (u_enc_out, u_enc_hidden, u_emb) = \
+                self.u_encoder.forward_pair(prev_z_input, prev_z_len, u_input, u_len)
+        else:
+            u_enc_out, u_enc_hidden, u_emb = self.u_encoder(u_input, u_len) 
         
       
         last_hidden = u_enc_hidden[:-1]
       
         last_hidden_bypass_z = last_hidden
 
+        # copy sources are fixed for the whole turn
+        sparse_u_input = get_copy_input_aug(u_input_np)
+        sparse_pv_z_input = get_copy_input_aug(prev_z_input_np) if pv_z_enc_out is not None else None
+
 
         z_tm1 = cuda_(Variable(torch.ones(1, batch_size).long() * 3))  # GO_2 token
         
@@ -503,7 +795,6 @@ class TSD(nn.Module):
             pz_dec_outs = []
             pz_proba = []
             z_length = z_input.size(0) if z_input is not None else self.z_length  # GO token
-            hiddens = [None] * batch_size
     
             last_hidden = last_hidden_bypass_z
             
@@ -522,25 +813,35 @@ class TSD(nn.Module):
             z3_hiddens = [None] * batch_size
 
             
+            # rows padded beyond their own turn, see turn_parallel_loss
+            pad_lengths = kwargs.get('pad_lengths') or {}
+            u_mask = length_mask(pad_lengths.get('u'), u_enc_out.size(0))
+            pv_z_mask = length_mask(pad_lengths.get('prev_z'), pv_z_enc_out.size(0)) \
+                if pv_z_enc_out is not None else None
+            z_mask = length_mask(pad_lengths.get('z'), z1_length)
+            z3_mask = length_mask(pad_lengths.get('z3'), z3_length)
+
+            z1_keys = self.z1_decoder.project_keys(u_enc_out, pv_z_enc_out)
+            captured, seen = None, None  # see capture_stop_hidden
             for t in range(z1_length):
-                pz1_dec_out, last_hidden, proba = \
+                active = step_active(z_mask, t)
+                pz1_dec_out, step_hidden, proba = \
                     self.z1_decoder(u_enc_out=u_enc_out, u_input_np=u_input_np,
                                    z_tm1=z1_tm1, last_hidden=last_hidden,
                                    pv_z_enc_out=pv_z_enc_out, prev_z_input_np=prev_z_input_np,
-                                   u_emb=u_emb, pv_z_emb=pv_z1_emb, position=t)
+                                   u_emb=u_emb, pv_z_emb=pv_z1_emb, position=t,
+                                   sparse_u_input=sparse_u_input, sparse_pv_z_input=sparse_pv_z_input,
+                                   attn_keys=z1_keys, log_proba=cfg.log_proba,
+                                   u_pad_mask=u_mask, pv_z_pad_mask=pv_z_mask)
+                last_hidden = keep_inactive(step_hidden, last_hidden, active)
                 pz1_proba.append(proba)
                 pz1_dec_outs.append(pz1_dec_out)
-                z1_np = z1_tm1.view(-1).cpu().data.numpy()
-                for i in range(batch_size):
-                    if z1_np[i] == self.vocab.encode('EOS_Z2'):
-                        hiddens[i] = last_hidden[:, i, :]
+                captured, seen = capture_stop_hidden(last_hidden, z1_tm1, self.vocab.encode('EOS_Z2'),
+                                                     captured, seen, active)
                 z1_tm1 = z1_input[t].view(1, -1)
 
             
-            for i in range(batch_size):
-                if hiddens[i] is None:
-                    hiddens[i] = last_hidden[:, i, :]
-            last_hidden = torch.stack(hiddens, dim=1)
+            last_hidden = torch.where(seen, captured, last_hidden)
             z1_input_np = z1_input.cpu().data.numpy()
             pz1_dec_outs = torch.cat(pz1_dec_outs, dim=0)  # [Tz,B,H]
             pz1_proba = torch.stack(pz1_proba, dim=0)
@@ -551,26 +852,27 @@ class TSD(nn.Module):
             z_input_np = z1_input_np 
             
 
+            z3_keys = self.z3_decoder.project_keys(pz_dec_outs, pv_z_enc_out)
+            # rows never fed <split> fall back to the hidden handed over by z1, not to the last z3 hidden
+            captured, seen = last_hidden, torch.ones_like(seen)
             for t in range(z3_length):
                 stop_tok = [self.vocab.encode('EOS_Z2')]
-                pz3_dec_out, last_hidden, proba = \
+                active = step_active(z3_mask, t)
+                pz3_dec_out, step_hidden, proba = \
                     self.z3_decoder(u_enc_out=pz_dec_outs, u_input_np=z_input_np,
                                    z_tm1=z3_tm1, last_hidden=last_hidden,
                                    pv_z_enc_out=pv_z_enc_out, prev_z_input_np=prev_z_input_np,
                                    u_emb=u_emb, pv_z_emb=pv_z3_emb, position=t,
-                                   stop_tok = stop_tok)
+                                   stop_tok = stop_tok, attn_keys=z3_keys, log_proba=cfg.log_proba,
+                                   u_pad_mask=z_mask, pv_z_pad_mask=pv_z_mask)
+                last_hidden = keep_inactive(step_hidden, last_hidden, active)
                 pz3_proba.append(proba)
                 pz3_dec_outs.append(pz3_dec_out)
-                z3_np = z3_tm1.view(-1).cpu().data.numpy()
-                for i in range(batch_size):
-                    if z3_np[i] == self.vocab.encode('<split>'):
-                        hiddens[i] = last_hidden[:, i, :]
+                captured, seen = capture_stop_hidden(last_hidden, z3_tm1, self.vocab.encode('<split>'),
+                                                     captured, seen, active)
                 z3_tm1 = z3_input[t].view(1, -1)
 
-            for i in range(batch_size):
-                if hiddens[i] is None:
-                    hiddens[i] = last_hidden[:, i, :]
-            last_hidden = torch.stack(hiddens, dim=1)
+            last_hidden = torch.where(seen, captured, last_hidden)
             z3_input_np = z3_input.cpu().data.numpy()
             pz3_dec_outs = torch.cat(pz3_dec_outs, dim=0)  
             pz3_proba = torch.stack(pz3_proba, dim=0)
@@ -579,11 +881,16 @@ class TSD(nn.Module):
 
             pm_dec_proba, m_dec_outs = [], []
             m_length = m_input.size(0)  # Tm
+            sparse_z_input = self.m_decoder.get_selective_copy_input(z_input_np, kwargs.get('z_copy_np'))
+            m_keys = self.m_decoder.project_keys(pz_dec_outs, u_enc_out)
             for t in range(m_length):
                 teacher_forcing = toss_(self.teacher_force)
 
                 proba, last_hidden, dec_out = self.m_decoder(pz_dec_outs, u_enc_out, u_input_np, m_tm1,
-                                                             degree_input, last_hidden, z_input_np)
+                                                             degree_input, last_hidden, z_input_np,
+                                                             sparse_z_input=sparse_z_input, attn_keys=m_keys,
+                                                             log_proba=cfg.log_proba, z_pad_mask=z_mask,
+                                                             u_pad_mask=u_mask)
                 
                 if teacher_forcing:
                     m_tm1 = m_input[t].view(1, -1)
@@ -604,7 +911,9 @@ class TSD(nn.Module):
             pz1_dec_outs, bspan1_index, last_hidden = self.bspan1_decoder(u_enc_out, z1_tm1, last_hidden, u_input_np,
                                                                        pv_z_enc_out=pv_z_enc_out,
                                                                        prev_z_input_np=prev_z_input_np,
-                                                                       u_emb=u_emb, pv_z_emb=pv_z1_emb)
+                                                                       u_emb=u_emb, pv_z_emb=pv_z1_emb,
+                                                                       sparse_u_input=sparse_u_input,
+                                                                       sparse_pv_z_input=sparse_pv_z_input)
             
             pz1_dec_outs = torch.cat(pz1_dec_outs, dim=0)
             
@@ -677,7 +986,7 @@ class TSD(nn.Module):
         pz_proba = []
         decoded = []
         batch_size = pv_z_enc_out.size(1)
-        hiddens = [None] * batch_size
+        captured, seen = None, None  # see capture_stop_hidden
         for t in range(cfg.z_length):
             pz_dec_out, last_hidden, proba = \
                 self.z_decoder(u_enc_out=u_enc_out, u_input_np=u_input_np,
@@ -688,52 +997,40 @@ class TSD(nn.Module):
             z_proba, z_index = torch.topk(proba, 1)  # [B,1]
             z_index = z_index.data.view(-1)
             decoded.append(z_index.clone())
-            for i in range(z_index.size(0)):
-                if z_index[i] >= cfg.vocab_size:
-                    z_index[i] = 2  # unk
-            z_np = z_tm1.view(-1).cpu().data.numpy()
-            for i in range(batch_size):
-                if z_np[i] == self.vocab.encode('EOS_Z2'):
-                    hiddens[i] = last_hidden[:, i, :]
+            z_index = z_index.masked_fill(z_index >= cfg.vocab_size, 2)  # unk
+            captured, seen = capture_stop_hidden(last_hidden, z_tm1, self.vocab.encode('EOS_Z2'), captured, seen)
             z_tm1 = cuda_(Variable(z_index).view(1, -1))
-        for i in range(batch_size):
-            if hiddens[i] is None:
-                hiddens[i] = last_hidden[:, i, :]
-        last_hidden = torch.stack(hiddens, dim=1)
+        last_hidden = torch.where(seen, captured, last_hidden)
         decoded = torch.stack(decoded, dim=0).transpose(0, 1)
         decoded = list(decoded)
         decoded = [list(_) for _ in decoded]
         return pz_dec_outs, decoded, last_hidden
 
 
-    def bspan1_decoder(self, u_enc_out, z_tm1, last_hidden, u_input_np, pv_z_enc_out, prev_z_input_np, u_emb, pv_z_emb):
+    def bspan1_decoder(self, u_enc_out, z_tm1, last_hidden, u_input_np, pv_z_enc_out, prev_z_input_np, u_emb, pv_z_emb,
+                       sparse_u_input=None, sparse_pv_z_input=None):
         pz_dec_outs = []
         pz_proba = []
         decoded = []
         batch_size = pv_z_enc_out.size(1)
-        hiddens = [None] * batch_size
+        captured, seen = None, None  # see capture_stop_hidden
+        attn_keys = self.z1_decoder.project_keys(u_enc_out, pv_z_enc_out)
         for t in range(cfg.z_length):
             pz_dec_out, last_hidden, proba = \
                 self.z1_decoder(u_enc_out=u_enc_out, u_input_np=u_input_np,
                                z_tm1=z_tm1, last_hidden=last_hidden, pv_z_enc_out=pv_z_enc_out,
-                               prev_z_input_np=prev_z_input_np, u_emb=u_emb, pv_z_emb=pv_z_emb, position=t)
+                               prev_z_input_np=prev_z_input_np, u_emb=u_emb, pv_z_emb=pv_z_emb, position=t,
+                               sparse_u_input=sparse_u_input, sparse_pv_z_input=sparse_pv_z_input,
+                               attn_keys=attn_keys)
             pz_proba.append(proba)
             pz_dec_outs.append(pz_dec_out)
             z_proba, z_index = torch.topk(proba, 1)  # [B,1]
             z_index = z_index.data.view(-1)
             decoded.append(z_index.clone())
-            for i in range(z_index.size(0)):
-                if z_index[i] >= cfg.vocab_size:
-                    z_index[i] = 2  # unk
-            z_np = z_tm1.view(-1).cpu().data.numpy()
-            for i in range(batch_size):
-                if z_np[i] == self.vocab.encode('EOS_Z2'):
-                    hiddens[i] = last_hidden[:, i, :]
+            z_index = z_index.masked_fill(z_index >= cfg.vocab_size, 2)  # unk
+            captured, seen = capture_stop_hidden(last_hidden, z_tm1, self.vocab.encode('EOS_Z2'), captured, seen)
             z_tm1 = cuda_(Variable(z_index).view(1, -1))
-        for i in range(batch_size):
-            if hiddens[i] is None:
-                hiddens[i] = last_hidden[:, i, :]
-        last_hidden = torch.stack(hiddens, dim=1)
+        last_hidden = torch.where(seen, captured, last_hidden)
         decoded = torch.stack(decoded, dim=0).transpose(0, 1)
         decoded = list(decoded)
         decoded = [list(_) for _ in decoded]
@@ -744,7 +1041,7 @@ class TSD(nn.Module):
         pz_proba = []
         decoded = []
         batch_size = pv_z_enc_out.size(1)
-        hiddens = [None] * batch_size
+        captured, seen = None, None  # see capture_stop_hidden
         for t in range(cfg.z_length):
             pz_dec_out, last_hidden, proba = \
                 self.z2_decoder(u_enc_out=u_enc_out, u_input_np=u_input_np,
@@ -755,18 +1052,10 @@ class TSD(nn.Module):
             z_proba, z_index = torch.topk(proba, 1)  # [B,1]
             z_index = z_index.data.view(-1)
             decoded.append(z_index.clone())
-            for i in range(z_index.size(0)):
-                if z_index[i] >= cfg.vocab_size:
-                    z_index[i] = 2  # unk
-            z_np = z_tm1.view(-1).cpu().data.numpy()
-            for i in range(batch_size):
-                if z_np[i] == self.vocab.encode('EOS_Z2'):
-                    hiddens[i] = last_hidden[:, i, :]
+            z_index = z_index.masked_fill(z_index >= cfg.vocab_size, 2)  # unk
+            captured, seen = capture_stop_hidden(last_hidden, z_tm1, self.vocab.encode('EOS_Z2'), captured, seen)
             z_tm1 = cuda_(Variable(z_index).view(1, -1))
-        for i in range(batch_size):
-            if hiddens[i] is None:
-                hiddens[i] = last_hidden[:, i, :]
-        last_hidden = torch.stack(hiddens, dim=1)
+        last_hidden = torch.where(seen, captured, last_hidden)
         decoded = torch.stack(decoded, dim=0).transpose(0, 1)
         decoded = list(decoded)
         decoded = [list(_) for _ in decoded]
@@ -777,30 +1066,23 @@ class TSD(nn.Module):
         pz_proba = []
         decoded = []
         batch_size = pv_z_enc_out.size(1)
-        hiddens = [None] * batch_size
+        captured, seen = None, None  # see capture_stop_hidden
+        attn_keys = self.z3_decoder.project_keys(u_enc_out, pv_z_enc_out)
         for t in range(cfg.z_length):
             pz_dec_out, last_hidden, proba = \
                 self.z3_decoder(u_enc_out=u_enc_out, u_input_np=u_input_np,
                                z_tm1=z_tm1, last_hidden=last_hidden, pv_z_enc_out=pv_z_enc_out,
                                prev_z_input_np=prev_z_input_np, u_emb=u_emb, pv_z_emb=pv_z_emb, position=t,
-                               stop_tok=stop_tok)
+                               stop_tok=stop_tok, attn_keys=attn_keys)
             pz_proba.append(proba)
             pz_dec_outs.append(pz_dec_out)
             z_proba, z_index = torch.topk(proba, 1)  # [B,1]
             z_index = z_index.data.view(-1)
             decoded.append(z_index.clone())
-            for i in range(z_index.size(0)):
-                if z_index[i] >= cfg.vocab_size:
-                    z_index[i] = 2  # unk
-            z_np = z_tm1.view(-1).cpu().data.numpy()
-            for i in range(batch_size):
-                if z_np[i] == self.vocab.encode('<split>'):
-                    hiddens[i] = last_hidden[:, i, :]
+            z_index = z_index.masked_fill(z_index >= cfg.vocab_size, 2)  # unk
+            captured, seen = capture_stop_hidden(last_hidden, z_tm1, self.vocab.encode('<split>'), captured, seen)
             z_tm1 = cuda_(Variable(z_index).view(1, -1))
-        for i in range(batch_size):
-            if hiddens[i] is None:
-                hiddens[i] = last_hidden[:, i, :]
-        last_hidden = torch.stack(hiddens, dim=1)
+        last_hidden = torch.where(seen, captured, last_hidden)
         decoded = torch.stack(decoded, dim=0).transpose(0, 1)
         decoded = list(decoded)
         decoded = [list(_) for _ in decoded]
@@ -809,134 +1091,124 @@ class TSD(nn.Module):
 
 
     def greedy_decode(self, pz_dec_outs, u_enc_out, m_tm1, u_input_np, last_hidden, degree_input, bspan_index):
-        decoded = []
-        bspan_index_np = pad_sequences(bspan_index).transpose((1, 0))
+        """
+        greedy decoding, stops once every response has produced EOS_M. With cfg.shrink_finished the finished
+        rows are also dropped from the batch. Words after EOS_M are filled with EOS_M.
+        """
+        eos_token_id = self.vocab.encode(cfg.eos_m_token)
+        batch_size = m_tm1.size(1)
+        bspan_index_np = pad_sequences(bspan_index, time_major=True)
+        sparse_z_input = self.m_decoder.get_selective_copy_input(bspan_index_np)
+        attn_keys = self.m_decoder.project_keys(pz_dec_outs, u_enc_out)
+        decoded = np.full((batch_size, self.max_ts), eos_token_id, dtype=np.int64)
+        finished = np.zeros(batch_size, dtype=bool)
+        active = np.arange(batch_size)  # rows of the original batch still being decoded
         for t in range(self.max_ts):
             proba, last_hidden, _ = self.m_decoder(pz_dec_outs, u_enc_out, u_input_np, m_tm1,
-                                                   degree_input, last_hidden, bspan_index_np)
+                                                   degree_input, last_hidden, bspan_index_np,
+                                                   sparse_z_input=sparse_z_input, attn_keys=attn_keys)
             mt_proba, mt_index = torch.topk(proba, 1)  # [B,1]
-            mt_index = mt_index.data.view(-1)
-            decoded.append(mt_index.clone())
-            for i in range(mt_index.size(0)):
-                if mt_index[i] >= cfg.vocab_size:
-                    mt_index[i] = 2  # unk
-            m_tm1 = cuda_(Variable(mt_index).view(1, -1))
-        decoded = torch.stack(decoded, dim=0).transpose(0, 1)
-        decoded = list(decoded)
+            mt_index = mt_index.data.view(-1).cpu().numpy()
+            decoded[active, t] = mt_index
+            finished[active[mt_index == eos_token_id]] = True
+            if finished.all():
+                decoded = decoded[:, :t + 1]
+                break
+            mt_index[mt_index >= cfg.vocab_size] = 2  # unk
+            m_tm1 = cuda_(Variable(torch.from_numpy(mt_index).long()).view(1, -1))
+            if cfg.shrink_finished and finished[active].any():
+                keep = np.flatnonzero(~finished[active])
+                keep_var = cuda_(Variable(torch.from_numpy(keep).long()))
+                active = active[keep]
+                pz_dec_outs, u_enc_out = pz_dec_outs.index_select(1, keep_var), u_enc_out.index_select(1, keep_var)
+                last_hidden, degree_input = last_hidden.index_select(1, keep_var), degree_input.index_select(0, keep_var)
+                m_tm1 = m_tm1.index_select(1, keep_var)
+                u_input_np, bspan_index_np = u_input_np[:, keep], bspan_index_np[:, keep]
+                sparse_z_input = select_copy_input(sparse_z_input, keep_var)
+                attn_keys = select_attn_keys(attn_keys, keep_var)
         return [list(_) for _ in decoded]
 
-    def beam_search_decode_single(self, pz_dec_outs, u_enc_out, m_tm1, u_input_np, last_hidden, degree_input,
-                                  bspan_index):
+    def beam_search_decode(self, pz_dec_outs, u_enc_out, m_tm1, u_input_np, last_hidden, degree_input, bspan_index):
+        """
+        Beam search over the whole batch. Every example keeps its own beam, scored and pruned exactly like the
+        per-example search; only the m_decoder calls of all live hypotheses of a step are batched together.
+        Hypotheses ending with EOS_M are finished if they mention every requested slot of the bspan, otherwise
+        failed; every finished hypothesis narrows the beam of its example by one.
+        :return: list of B decoded index lists, starting with the GO token
+        """
         eos_token_id = self.vocab.encode(cfg.eos_m_token)
-        batch_size = pz_dec_outs.size(1)
-        if batch_size != 1:
-            raise ValueError('"Beam search single" requires batch size to be 1')
-
-        class BeamState:
-            def __init__(self, score, last_hidden, decoded, length):
-                """
-                Beam state in beam decoding
-                :param score: sum of log-probabilities
-                :param last_hidden: last hidden
-                :param decoded: list of *Variable[1*1]* of all decoded words
-                :param length: current decoded sentence length
-                """
-                self.score = score
-                self.last_hidden = last_hidden
-                self.decoded = decoded
-                self.length = length
-
-            def update_clone(self, score_incre, last_hidden, decoded_t):
-                decoded = copy.copy(self.decoded)
-                decoded.append(decoded_t)
-                clone = BeamState(self.score + score_incre, last_hidden, decoded, self.length + 1)
-                return clone
-
-        def beam_result_valid(decoded_t, bspan_index):
-            decoded_t = [_.view(-1).data[0] for _ in decoded_t]
-            req_slots = self.get_req_slots(bspan_index)
-            decoded_sentence = self.vocab.sentence_decode(decoded_t, cfg.eos_m_token)
-            for req in req_slots:
+        batch_size, beam_size = pz_dec_outs.size(1), self.beam_size
+        bspan_index_np = pad_sequences(bspan_index, time_major=True)
+        sparse_z_input = self.m_decoder.get_selective_copy_input(bspan_index_np)
+        attn_keys = self.m_decoder.project_keys(pz_dec_outs, u_enc_out)
+        req_slots = [self.get_req_slots(_) for _ in bspan_index]
+        go_token = m_tm1.data.view(-1).cpu().numpy()
+
+        def beam_result_valid(b, decoded):
+            decoded_sentence = self.vocab.sentence_decode(decoded, cfg.eos_m_token)
+            for req in req_slots[b]:
                 if req not in decoded_sentence:
                     return False
             return True
 
-        def score_bonus(state, decoded, bspan_index):
-            bonus = cfg.beam_len_bonus
-            return bonus
-
-        def soft_score_incre(score, turn):
-            return score
-
-        finished, failed = [], []
-        states = []  # sorted by score decreasingly
-        dead_k = 0
-        states.append(BeamState(0, last_hidden, [m_tm1], 0))
-        bspan_index_np = np.array(bspan_index).reshape(-1, 1)
+        # a hypothesis is (score, row of its hidden state in last_hidden, decoded words), sorted by score
+        states = [[(0, b, [int(go_token[b])])] for b in range(batch_size)]
+        finished = [[] for _ in range(batch_size)]
+        failed = [[] for _ in range(batch_size)]
+        dead_k = [0] * batch_size
         for t in range(self.max_ts):
-            new_states = []
-            k = 0
-            while k < len(states) and k < self.beam_size - dead_k:
-                state = states[k]
-                last_hidden, m_tm1 = state.last_hidden, state.decoded[-1]
-                proba, last_hidden, _ = self.m_decoder(pz_dec_outs, u_enc_out, u_input_np, m_tm1, degree_input,
-                                                       last_hidden, bspan_index_np)
-
+            run = [(b, k) for b in range(batch_size) for k in range(min(len(states[b]), beam_size - dead_k[b]))]
+            if not run:
+                break
+            ex_var = cuda_(Variable(torch.from_numpy(np.array([b for b, _ in run])).long()))
+            hidden_var = cuda_(Variable(torch.from_numpy(np.array([states[b][k][1] for b, k in run])).long()))
+            m_tm1 = cuda_(Variable(torch.from_numpy(np.array([[states[b][k][2][-1] for b, k in run]])).long()))
+            ex_rows = ex_var.data.cpu().numpy()
+            proba, last_hidden, _ = self.m_decoder(pz_dec_outs.index_select(1, ex_var),
+                                                   u_enc_out.index_select(1, ex_var), u_input_np[:, ex_rows],
+                                                   m_tm1, degree_input.index_select(0, ex_var),
+                                                   last_hidden.index_select(1, hidden_var),
+                                                   bspan_index_np[:, ex_rows],
+                                                   sparse_z_input=select_copy_input(sparse_z_input, ex_var),
+                                                   attn_keys=select_attn_keys(attn_keys, ex_var),
+                                                   log_proba=cfg.log_proba)
+            if not cfg.log_proba:
                 proba = torch.log(proba)
-                mt_proba, mt_index = torch.topk(proba, self.beam_size - dead_k)  # [1,K]
-                for new_k in range(self.beam_size - dead_k):
-                    # score_incre = soft_score_incre(mt_proba[0][new_k].data[0], t) + score_bonus(state,
-                    #                                                                             mt_index[0][new_k].data[
-                    #                                                                                 0], bspan_index)
-                    score_incre = soft_score_incre(mt_proba[0][new_k].item(), t) + score_bonus(state,
-                                                                                                mt_index[0][new_k].item(), bspan_index)
-                    if len(new_states) >= self.beam_size - dead_k and state.score + score_incre < new_states[-1].score:
+            mt_proba, mt_index = torch.topk(proba, beam_size)
+            mt_proba, mt_index = mt_proba.data.cpu().numpy(), mt_index.data.cpu().numpy()
+
+            # candidates are visited state by state, in the order and with the pruning of the per-example search
+            new_states = [[] for _ in range(batch_size)]
+            for row, (b, k) in enumerate(run):
+                if k >= beam_size - dead_k[b]:
+                    continue
+                score, _, decoded = states[b][k]
+                for new_k in range(beam_size - dead_k[b]):
+                    score_incre = float(mt_proba[row, new_k]) + cfg.beam_len_bonus
+                    if len(new_states[b]) >= beam_size - dead_k[b] and score + score_incre < new_states[b][-1][0]:
                         break
-                    decoded_t = mt_index[0][new_k]
-                    if decoded_t.item() >= cfg.vocab_size:
-                        decoded_t.data[0] = 2  # unk
-                    if self.vocab.decode(decoded_t.item()) == cfg.eos_m_token:
-                        if beam_result_valid(state.decoded, bspan_index):
-                            finished.append(state)
-                            dead_k += 1
+                    decoded_t = int(mt_index[row, new_k])
+                    if decoded_t >= cfg.vocab_size:
+                        decoded_t = 2  # unk
+                    if decoded_t == eos_token_id:
+                        if beam_result_valid(b, decoded):
+                            finished[b].append((score, decoded))
+                            dead_k[b] += 1
                         else:
-                            failed.append(state)
+                            failed[b].append((score, decoded))
                     else:
-                        decoded_t = decoded_t.view(1, -1)
-                        new_state = state.update_clone(score_incre, last_hidden, decoded_t)
-                        new_states.append(new_state)
-
-                k += 1
-            if self.beam_size - dead_k < 0:
-                break
-            new_states = new_states[:self.beam_size - dead_k]
-            new_states.sort(key=lambda x: -x.score)
-            states = new_states
-
-            if t == self.max_ts - 1 and not finished:
-                finished = failed
-                print('FAIL')
-                if not finished:
-                    finished.append(states[0])
-
-        finished.sort(key=lambda x: -x.score)
-        decoded_t = finished[0].decoded
-        decoded_t = [_.view(-1).data[0] for _ in decoded_t]
-        decoded_sentence = self.vocab.sentence_decode(decoded_t, cfg.eos_m_token)
-        print(decoded_sentence)
-        generated = torch.cat(finished[0].decoded, dim=1).data  # [B=1, T]
-        return generated
+                        new_states[b].append((score + score_incre, row, decoded + [decoded_t]))
+            for b in range(batch_size):
+                states[b] = sorted(new_states[b][:beam_size - dead_k[b]], key=lambda x: -x[0])
 
-    def beam_search_decode(self, pz_dec_outs, u_enc_out, m_tm1, u_input_np, last_hidden, degree_input, bspan_index):
-        vars = torch.split(pz_dec_outs, 1, dim=1), torch.split(u_enc_out, 1, dim=1), torch.split(
-            m_tm1, 1, dim=1), torch.split(last_hidden, 1, dim=1), torch.split(degree_input, 1, dim=0)
         decoded = []
-        for i, (pz_dec_out_s, u_enc_out_s, m_tm1_s, last_hidden_s, degree_input_s) in enumerate(zip(*vars)):
-            decoded_s = self.beam_search_decode_single(pz_dec_out_s, u_enc_out_s, m_tm1_s,
-                                                       u_input_np[:, i].reshape((-1, 1)),
-                                                       last_hidden_s, degree_input_s, bspan_index[i])
-            decoded.append(decoded_s)
-        return [list(_.view(-1)) for _ in decoded]
+        for b in range(batch_size):
+            candidates = finished[b]
+            if not candidates:
+                logging.debug('FAIL')
+                candidates = failed[b] or states[b][:1]
+            decoded.append(sorted(candidates, key=lambda x: -x[0])[0][-1])
+        return decoded
 
     def supervised_loss(self, pz_proba, pz1_proba, pz2_proba, pz3_proba, pm_dec_proba, z_input,z1_input,z2_input,z3_input, m_input):
         pz_proba, pm_dec_proba = pz_proba[:, :, :cfg.vocab_size].contiguous(), pm_dec_proba[:, :,
@@ -1054,6 +1326,8 @@ class TSD(nn.Module):
         log_probs = []
         rewards = []
         bspan_index_np = np.array(bspan_index).reshape(-1, 1)
+        sparse_z_input = self.m_decoder.get_selective_copy_input(bspan_index_np)
+        attn_keys = self.m_decoder.project_keys(pz_dec_outs, u_enc_out)
         for t in range(self.max_ts):
             # reward
             reward, finished = self.reward(m_tm1.data.view(-1), decoded, bspan_index)
@@ -1066,7 +1340,8 @@ class TSD(nn.Module):
                 return loss
             # action
             proba, last_hidden, _ = self.m_decoder(pz_dec_outs, u_enc_out, u_input_np, m_tm1,
-                                                   degree_input, last_hidden, bspan_index_np)
+                                                   degree_input, last_hidden, bspan_index_np,
+                                                   sparse_z_input=sparse_z_input, attn_keys=attn_keys)
             proba = proba.squeeze(0)  # [B,V]
             dis = Categorical(proba)
             action = dis.sample()